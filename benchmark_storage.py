@@ -0,0 +1,108 @@
+import argparse
+import datetime
+import os
+import random
+import sys
+import tempfile
+import time
+
+import pytz
+from bson import ObjectId
+
+# The Mongo reads go through the web app's query planner
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), 'html'))
+
+from config import config
+from sensor_types import types
+from storage import MongoStorage, SQLiteStorage
+
+
+def synthetic_readings(count, step=5):
+    """count readings step seconds apart up to now, with a daily cycle, noise and now and then a spike"""
+    end = datetime.datetime.now(pytz.UTC)
+    rng = random.Random(1)
+    docs = []
+    for i in range(count):
+        t = end - datetime.timedelta(seconds=step * (count - i))
+        day = (t.hour * 3600 + t.minute * 60) / 86400
+        doc = {'_id': ObjectId(), 'timestamp': t}
+        for j, rtype in enumerate(types):
+            doc[rtype] = 10 * (j + 1) + 5 * abs(day - 0.5) + rng.gauss(0, 1) + (50 if rng.random() < 0.001 else 0)
+        docs.append(doc)
+    return docs
+
+
+def timed(func, repeat=3):
+    """The best time of repeat runs, in ms"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def benchmark(storage, docs):
+    results = []
+    start = time.perf_counter()
+    # In the batches the writer uses
+    for i in range(0, len(docs), 50):
+        storage.insert(docs[i:i + 50])
+    results.append(('insert', (time.perf_counter() - start) * 1000))
+
+    now = docs[-1]['timestamp']
+    for name, hours, interval in (('series day', 24, 1800), ('series week', 24 * 7, 6300),
+                                  ('series month', 24 * 31, 111600)):
+        start_time = now - datetime.timedelta(hours=hours)
+        results.append((name, timed(lambda: storage.series(['pressure', 'pm25'], start_time, now, interval))))
+    month = now - datetime.timedelta(days=31)
+    week = now - datetime.timedelta(days=7)
+    day = now - datetime.timedelta(days=1)
+    results.append(('range sums month', timed(lambda: storage.range_sums('pressure', {'month': (month, now)}))))
+    results.append(('quantiles week', timed(lambda: storage.quantiles('pm25', week, now))))
+    results.append(('points day', timed(lambda: storage.points('pm25', day, now))))
+    results.append(('latest', timed(storage.latest)))
+    results.append(('latest 100 rows', timed(lambda: storage.latest_rows(100))))
+    results.append(('scan 10000 rows', timed(lambda: sum(1 for _ in storage.scan(types, limit=10000)))))
+    # Everything before today's midnight
+    results.append(('compact', timed(lambda: storage.compact(0, None), repeat=1)))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time the storage operations of the collector and the web app on "
+                                                 "synthetic readings, in the SQLite backend and optionally in Mongo")
+    parser.add_argument("--readings", type=int, default=200000, help="Number of readings, 5 seconds apart")
+    parser.add_argument("--mongo", action='store_true', help="Benchmark the Mongo backend too")
+    parser.add_argument("--mongo-database", default="enviro_benchmark",
+                        help="Scratch database for the Mongo benchmark; it is dropped before and after")
+    args = parser.parse_args()
+
+    docs = synthetic_readings(args.readings)
+    backends = []
+    with tempfile.TemporaryDirectory() as directory:
+        backends.append(('sqlite', benchmark(SQLiteStorage(os.path.join(directory, 'benchmark.sqlite')),
+                                             [dict(doc) for doc in docs])))
+    if args.mongo:
+        from mongo_connector import MongoConnector
+        from planner import QueryPlanner
+        from rollup import Rollups
+        from sketch import Sketches
+
+        mongo = MongoConnector(dict(config, database=args.mongo_database))
+        client = mongo.get_db().client
+        client.drop_database(args.mongo_database)
+        mongo.ensure_indexes()
+        rollups = Rollups(mongo.get_db())
+        sketches = Sketches(mongo.get_db())
+        storage = MongoStorage(mongo, rollups, sketches, QueryPlanner(mongo, rollups, None, sketches))
+        try:
+            backends.append(('mongo', benchmark(storage, [dict(doc) for doc in docs])))
+        finally:
+            client.drop_database(args.mongo_database)
+
+    print("{} readings; best of 3 in ms".format(len(docs)))
+    print("{:<18}".format("") + "".join("{:>12}".format(name) for name, _ in backends))
+    for i, (operation, _) in enumerate(backends[0][1]):
+        print("{:<18}".format(operation) + "".join("{:>12.1f}".format(results[i][1]) for _, results in backends))
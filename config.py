@@ -9,4 +9,11 @@ config = {
     "auth_db": "enviro",
     "city": "Amsterdam",
     "time_zone": "CET",
+    "spool_file": "enviro_spool.json",
+    "rollup_prefix": "rollup_",
+    "sketch_collection": "sketches",
+    "compaction_collection": "compaction",
+    # "mongo", or "sqlite" for a unit without a Mongo server
+    "backend": "mongo",
+    "sqlite_file": "enviro.sqlite",
 }
@@ -0,0 +1,320 @@
+import collections
+import colorsys
+import functools
+import logging
+import time
+
+import ST7735
+from PIL import Image, ImageDraw, ImageFont, ImageFilter
+from fonts.ttf import RobotoMedium as UserFont
+
+import metrics
+from ephemeris import get_ephemeris
+from trend import TrendEstimator
+
+
+def calculate_y_pos(x, centre=80):
+    """Calculates the y-coordinate on a parabolic curve, given x."""
+    y = 1 / centre * (x - centre) ** 2
+    return int(y)
+
+
+def circle_coordinates(x, y, radius):
+    """Calculates the bounds of a circle, given centre and radius."""
+    x1 = x - radius  # Left
+    x2 = x + radius  # Right
+    y1 = y - radius  # Bottom
+    y2 = y + radius  # Top
+    return x1, y1, x2, y2
+
+
+def map_colour(x, centre, start_hue, end_hue, day):
+    """Given an x coordinate and a centre point, a start and end hue (in degrees),
+       and a Boolean for day or night (day is True, night False), calculate a colour
+       hue representing the 'colour' of that time of day."""
+
+    start_hue /= 360  # Rescale to between 0 and 1
+    end_hue /= 360
+    sat = 1.0
+
+    # Dim the brightness as you move from the centre to the edges
+    val = 1 - (abs(centre - x) / (2 * centre))
+
+    # Ramp up towards centre, then back down
+    if x > centre:
+        x = (2 * centre) - x
+
+    # Calculate the hue
+    hue = start_hue + ((x / centre) * (end_hue - start_hue))
+
+    # At night, move towards purple/blue hues and reverse dimming
+    if not day:
+        hue = 1 - hue
+        val = 1 - val
+
+    r, g, b = [int(c * 255) for c in colorsys.hsv_to_rgb(hue, sat, val)]
+
+    return r, g, b
+
+
+def x_from_sun_moon_time(progress, period, x_range):
+    """Recalculate/rescale an amount of progress through a time period."""
+    x = int((progress / period) * x_range)
+    return x
+
+
+class Display:
+    _font_sm = ImageFont.truetype(UserFont, 12)
+    _font_lg = ImageFont.truetype(UserFont, 14)
+    _blur = 50
+    _opacity = 125
+    _margin = 3
+    _mid_hue = 0
+    _day_hue = 25
+    _sun_radius = 50
+    # The pressure trend is fitted over this many seconds, once at least _min_vals samples are in
+    _pressure_window = 3 * 60 * 60
+    _min_vals = 30
+    # The sun/moon position is rounded to this many pixels, so the blurred backgrounds can be reused
+    _sun_step = 2
+    _light_descriptions = ["dark", "dim", "light", "bright"]
+    _humidity_descriptions = ["good", "bad"]
+    _pressure_descriptions = ["storm", "rain", "change", "fair", "dry"]
+
+    def __init__(self, city, timezone, path):
+        self._ephemeris = get_ephemeris(city, timezone)
+        self._disp = ST7735.ST7735(port=0, cs=1, dc=9, backlight=12, rotation=270, spi_speed_hz=10000000)
+        self._disp.begin()
+        self._WIDTH = self._disp.width
+        self._HEIGHT = self._disp.height
+        self._path = path
+        self._temp_icon = self._load_icon("temperature")
+        self._light_icons = {x: self._load_icon(f"bulb-{x}") for x in self._light_descriptions}
+        self._humidity_icons = {x: self._load_icon(f"humidity-{x}") for x in self._humidity_descriptions}
+        self._pressure_icons = {x: self._load_icon(f"weather-{x}") for x in self._pressure_descriptions}
+        self._frame_times = collections.deque(maxlen=100)
+        self._min_temp = None
+        self._max_temp = None
+        self._pressure_trend = TrendEstimator(window=self._pressure_window)
+        self._trend = "-"
+        self.start_time = time.time()
+        self._backlight = False
+        self._black_img = Image.new('RGBA', (self._WIDTH, self._HEIGHT), color=(0, 0, 0, 0))
+
+    def _load_icon(self, name):
+        icon = Image.open(f"{self._path}/icons/{name}.png")
+        icon.load()
+        return icon
+
+    @staticmethod
+    def describe_pressure(pressure):
+        """Convert pressure into barometer-type description."""
+        if pressure < 970:
+            description = "storm"
+        elif 970 <= pressure < 990:
+            description = "rain"
+        elif 990 <= pressure < 1010:
+            description = "change"
+        elif 1010 <= pressure < 1030:
+            description = "fair"
+        elif pressure >= 1030:
+            description = "dry"
+        else:
+            description = ""
+        return description
+
+    @staticmethod
+    def describe_humidity(humidity):
+        """Convert relative humidity into good/bad description."""
+        if 40 < humidity < 60:
+            description = "good"
+        else:
+            description = "bad"
+        return description
+
+    @staticmethod
+    def describe_light(light):
+        """Convert light level in lux to descriptive value."""
+        if light < 50:
+            description = "dark"
+        elif 50 <= light < 100:
+            description = "dim"
+        elif 100 <= light < 500:
+            description = "light"
+        elif light >= 500:
+            description = "bright"
+        return description
+
+    def analyse_pressure(self, pressure, t):
+        self._pressure_trend.add(t, pressure)
+        mean_pressure = self._pressure_trend.mean()
+        line = self._pressure_trend.fit()
+        if len(self._pressure_trend) < self._min_vals or line is None:
+            self._trend = "-"
+            return mean_pressure, 0, self._trend
+
+        # Slope and confidence of the line of best fit
+        slope, intercept, r_squared = line
+
+        # Calculate change in pressure per hour
+        change_per_hour = slope * 60 * 60
+
+        # Calculate trend
+        if r_squared > 0.5:
+            if change_per_hour > 0.5:
+                self._trend = ">"
+            elif change_per_hour < -0.5:
+                self._trend = "<"
+            elif -0.5 <= change_per_hour <= 0.5:
+                self._trend = "-"
+
+            if self._trend != "-":
+                if abs(change_per_hour) > 3:
+                    self._trend *= 2
+        return mean_pressure, change_per_hour, self._trend
+
+    @functools.lru_cache(maxsize=256)
+    def _label(self, text, font, rectangle):
+        """Pre-rasterised text label: white text on a transparent background, or cut out of a white rectangle"""
+        w, h = font.getsize(text)
+        if rectangle:
+            label = Image.new('RGBA', (w + 2, h + 2), color=(0, 0, 0, 0))
+            draw = ImageDraw.Draw(label)
+            draw.rectangle((0, 0, w + 1, h + 1), (255, 255, 255))
+            draw.text((1, 0), text, font=font, fill=(0, 0, 0, 0))
+        else:
+            label = Image.new('RGBA', (w, h), color=(0, 0, 0, 0))
+            draw = ImageDraw.Draw(label)
+            draw.text((0, 0), text, font=font, fill=(255, 255, 255))
+        return label
+
+    def overlay_text(self, img, position, text, font, align_right=False, rectangle=False):
+        w, h = font.getsize(text)
+        x, y = position
+        if align_right:
+            x -= w
+        if rectangle:
+            # The text sits one pixel in from the left edge of its rectangle, which starts a pixel lower
+            y += 1
+        img.alpha_composite(self._label(text, font, rectangle), dest=(x, y))
+        return img
+
+    @functools.lru_cache(maxsize=32)
+    def _background(self, x, day):
+        """The blurred background for a sun/moon x-position; memoised as the blur is by far the costliest step"""
+        # Calculate position on sun/moon's curve
+        centre = self._WIDTH / 2
+        y = calculate_y_pos(x, centre)
+
+        # Background colour
+        background = map_colour(x, 80, self._mid_hue, self._day_hue, day)
+
+        # New image for background colour
+        img = Image.new('RGBA', (self._WIDTH, self._HEIGHT), color=background)
+        # draw = ImageDraw.Draw(img)
+
+        # New image for sun/moon overlay
+        overlay = Image.new('RGBA', (self._WIDTH, self._HEIGHT), color=(0, 0, 0, 0))
+        overlay_draw = ImageDraw.Draw(overlay)
+
+        # Draw the sun/moon
+        circle = circle_coordinates(x, y, self._sun_radius)
+        overlay_draw.ellipse(circle, fill=(200, 200, 50, self._opacity))
+
+        # Overlay the sun/moon on the background as an alpha matte
+        composite = Image.alpha_composite(img, overlay).filter(ImageFilter.GaussianBlur(radius=self._blur))
+
+        return composite
+
+    def draw_background(self, progress, period, day):
+        """Given an amount of progress through the day or night, draw the
+           background colour and overlay a blurred sun/moon."""
+
+        # x-coordinate for sun/moon
+        x = x_from_sun_moon_time(progress, period, self._WIDTH)
+
+        # If it's day, then move right to left
+        if day:
+            x = self._WIDTH - x
+        x = int(round(x / self._sun_step)) * self._sun_step
+
+        # The frame is drawn on, so hand out a copy of the cached background
+        return self._background(x, day).copy()
+
+    def get_frame_times(self):
+        """Render time statistics in seconds over the last 100 frames"""
+        if not self._frame_times:
+            return {'last': None, 'avg': None, 'max': None}
+        return {'last': self._frame_times[-1], 'avg': sum(self._frame_times) / len(self._frame_times),
+                'max': max(self._frame_times)}
+
+    def update_display(self, data_set):
+        self.enable()
+        start = time.monotonic()
+        progress, period, day, local_dt = self._ephemeris.progress()
+        time_string = local_dt.strftime("%H:%M")
+        date_string = local_dt.strftime("%d %b %y").lstrip('0')
+        temp_string = "{:.0f}°C".format(data_set['temperature'])
+        humidity_string = "{:.0f}%".format(data_set['humidity'])
+        mean_pressure, change_per_hour, trend = self.analyse_pressure(data_set['pressure'], time.time())
+        light_string = "{}".format(int(data_set['lux']))
+        light_desc = self.describe_light(data_set['lux']).upper()
+        humidity_desc = self.describe_humidity(data_set['humidity']).upper()
+        pressure_desc = self.describe_pressure(data_set['pressure']).upper()
+        pressure_string = f"{int(mean_pressure):,} {trend}"
+
+        light_icon = self._light_icons[light_desc.lower()]
+        humidity_icon = self._humidity_icons[humidity_desc.lower()]
+        pressure_icon = self._pressure_icons.get(pressure_desc.lower())
+        time_elapsed = time.time() - self.start_time
+
+        if time_elapsed > 30:
+            if self._min_temp is not None and self._max_temp is not None:
+                if data_set['temperature'] < self._min_temp:
+                    self._min_temp = data_set['temperature']
+                elif data_set['temperature'] > self._max_temp:
+                    self._max_temp = data_set['temperature']
+            else:
+                self._min_temp = data_set['temperature']
+                self._max_temp = data_set['temperature']
+
+        if self._min_temp is not None and self._max_temp is not None:
+            range_string = f"{self._min_temp:.0f}-{self._max_temp:.0f}"
+        else:
+            range_string = "------"
+        background = self.draw_background(progress, period, day)
+        img = self.overlay_text(background, (0 + self._margin, 0 + self._margin), time_string, self._font_lg)
+        img = self.overlay_text(img, (self._WIDTH - self._margin, 0 + self._margin), date_string, self._font_lg,
+                                align_right=True)
+        img = self.overlay_text(img, (68, 18), temp_string, self._font_lg, align_right=True)
+        img = self.overlay_text(img, (self._WIDTH - self._margin, 18), light_string, self._font_lg, align_right=True)
+        spacing = self._font_lg.getsize(light_string.replace(",", ""))[1] + 1
+        img = self.overlay_text(img, (self._WIDTH - self._margin - 1, 18 + spacing), light_desc, self._font_sm,
+                                align_right=True, rectangle=True)
+        img.paste(self._temp_icon, (self._margin, 18), mask=self._temp_icon)
+        img.paste(light_icon, (80, 18), mask=light_icon)
+        if pressure_icon is not None:
+            img.paste(pressure_icon, (80, 48), mask=pressure_icon)
+        img.paste(humidity_icon, (self._margin, 48), mask=humidity_icon)
+        spacing = self._font_lg.getsize(temp_string)[1] + 1
+        img = self.overlay_text(img, (68, 48), humidity_string, self._font_lg, align_right=True)
+        img = self.overlay_text(img, (68, 48 + spacing), humidity_desc, self._font_sm, align_right=True, rectangle=True)
+        img = self.overlay_text(img, (self._WIDTH - self._margin, 48), pressure_string, self._font_lg, align_right=True)
+        img = self.overlay_text(img, (68, 18 + spacing), range_string, self._font_sm, align_right=True, rectangle=True)
+        img = self.overlay_text(img, (self._WIDTH - self._margin - 1, 48 + spacing), pressure_desc, self._font_sm,
+                                align_right=True, rectangle=True)
+        self._frame_times.append(time.monotonic() - start)
+        metrics.DISPLAY_RENDER_SECONDS.observe(self._frame_times[-1])
+        logging.debug("Rendered display frame in {:.3f}s".format(self._frame_times[-1]))
+        self._disp.display(img)
+
+    def disable(self, force=False):
+        if self._backlight or force:
+            self._disp.display(self._black_img)
+            self._backlight = False
+            self._disp.set_backlight(0)
+
+    def enable(self):
+        if not self._backlight:
+            self._backlight = True
+            self._disp.set_backlight(1)
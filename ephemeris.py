@@ -0,0 +1,124 @@
+import datetime
+import functools
+import threading
+
+import pytz
+from astral.geocoder import database, lookup
+from astral.sun import sun
+
+
+@functools.lru_cache(maxsize=None)
+def _geocoder():
+    return database()
+
+
+@functools.lru_cache(maxsize=None)
+def find_city(name):
+    """Location info for a city from the astral geocoder; the database is only built once"""
+    return lookup(name, _geocoder())
+
+
+@functools.lru_cache(maxsize=None)
+def get_ephemeris(city, time_zone):
+    """The shared Ephemeris for a city and time zone"""
+    return Ephemeris(city, time_zone)
+
+
+class Ephemeris:
+    """Sunrises and sunsets of a city over a few days around today, so the current day or night period and the next
+       sunrise and sunset can be looked up without solving the sun's position again. The events are recalculated
+       once the cursor runs out of them, i.e. about once a day."""
+
+    def __init__(self, city, time_zone, days_before=1, days_after=2):
+        self._city = find_city(city)
+        self._timezone = pytz.timezone(time_zone)
+        self._days_before = days_before
+        self._days_after = days_after
+        self._lock = threading.Lock()
+        # Sorted event times and whether each is a sunrise; _index is the first event after the last lookup
+        self._times = []
+        self._sunrise = []
+        self._index = 0
+
+    def _calculate(self, now):
+        today = now.astimezone(self._timezone).date()
+        times = []
+        sunrise = []
+        for offset in range(-self._days_before, self._days_after + 1):
+            try:
+                events = sun(self._city.observer, date=today + datetime.timedelta(days=offset), tzinfo=self._timezone)
+            except ValueError:
+                # The sun doesn't rise or set that day (polar day or night)
+                continue
+            for name in ['sunrise', 'sunset']:
+                times.append(events[name])
+                sunrise.append(name == 'sunrise')
+        self._times = times
+        self._sunrise = sunrise
+        self._index = 0
+
+    def _locate(self, now):
+        """Move the cursor to the first event after now, with at least one event before and one more after it"""
+        times = self._times
+        if not times or now < times[max(self._index - 1, 0)]:
+            self._calculate(now)
+            times = self._times
+        while self._index < len(times) and times[self._index] <= now:
+            self._index += 1
+        if self._index == 0 or self._index + 1 >= len(times):
+            self._calculate(now)
+            times = self._times
+            while self._index < len(times) and times[self._index] <= now:
+                self._index += 1
+            if self._index == 0 or self._index + 1 >= len(times):
+                raise ValueError("No sunrise or sunset around {} in {}".format(now, self._city.name))
+        return self._index
+
+    def progress(self, now=None):
+        """Progress through the current day or night period: (progress, period, day, local time) with progress and
+           period in seconds"""
+        if now is None:
+            now = datetime.datetime.now(tz=pytz.utc)
+        with self._lock:
+            index = self._locate(now)
+            start = self._times[index - 1]
+            end = self._times[index]
+            day = self._sunrise[index - 1]
+        return (now - start).total_seconds(), (end - start).total_seconds(), day, now.astimezone(self._timezone)
+
+    def next_events(self, now=None):
+        """The next sunset and sunrise, in local time"""
+        if now is None:
+            now = datetime.datetime.now(tz=pytz.utc)
+        with self._lock:
+            index = self._locate(now)
+            following = self._times[index:index + 2]
+            if self._sunrise[index]:
+                next_sunrise, next_sunset = following
+            else:
+                next_sunset, next_sunrise = following
+        return next_sunset.astimezone(self._timezone), next_sunrise.astimezone(self._timezone)
+
+
+if __name__ == '__main__':
+    # Compare with solving the sun's position for each moment
+    ephemeris = Ephemeris('London', 'Europe/London')
+    city = find_city('London')
+    moment = datetime.datetime(2021, 3, 26, tzinfo=pytz.utc)
+    for _ in range(24 * 10):
+        moment += datetime.timedelta(minutes=61)
+        local = moment.astimezone(ephemeris._timezone)
+        events = []
+        for offset in range(-1, 3):
+            s = sun(city.observer, date=local.date() + datetime.timedelta(days=offset), tzinfo=ephemeris._timezone)
+            events += [(s['sunrise'], True), (s['sunset'], False)]
+        before = max(x for x in events if x[0] <= moment)
+        after = min(x for x in events if x[0] > moment)
+        progress, period, day, _ = ephemeris.progress(moment)
+        assert day == before[1]
+        assert progress == (moment - before[0]).total_seconds()
+        assert period == (after[0] - before[0]).total_seconds()
+        next_sunset, next_sunrise = ephemeris.next_events(moment)
+        assert next_sunrise == min(x[0] for x in events if x[0] > moment and x[1])
+        assert next_sunset == min(x[0] for x in events if x[0] > moment and not x[1])
+    print("ok")
@@ -0,0 +1,107 @@
+import logging
+import queue
+import threading
+import time
+
+
+class SensorHealth:
+    """Circuit breaker for a sensor. After threshold consecutive failures the sensor is left alone (open) for a
+       backoff period that doubles after every failed probe, up to max_backoff. When the period is over a single
+       read is let through as a probe (half-open): success closes the breaker again, failure reopens it."""
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name, threshold=3, backoff=2, max_backoff=300):
+        self.name = name
+        self._threshold = threshold
+        self._base_backoff = backoff
+        self._max_backoff = max_backoff
+        self._backoff = backoff
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._retry_at = 0
+        self.state = self.CLOSED
+        self.faults = 0
+        self.trips = 0
+        self.recoveries = 0
+        self.recovery_time = 0.0
+
+    def allow(self):
+        """Whether the sensor should be read now"""
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() >= self._retry_at:
+                self.state = self.HALF_OPEN
+                return True
+            return self.state == self.CLOSED
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                logging.info("Sensor {} recovered".format(self.name))
+            self.state = self.CLOSED
+            self._failures = 0
+            self._backoff = self._base_backoff
+
+    def record_failure(self):
+        """Count a failed read; returns True if this opened the breaker, i.e. recovery should be started"""
+        with self._lock:
+            self.faults += 1
+            self._failures += 1
+            if self.state == self.HALF_OPEN:
+                self._backoff = min(self._backoff * 2, self._max_backoff)
+            elif self.state == self.OPEN or self._failures < self._threshold:
+                return False
+            self.state = self.OPEN
+            self.trips += 1
+            self._retry_at = time.monotonic() + self._backoff
+            logging.warning("Sensor {} failed {} times in a row; retrying in {}s".format(self.name, self._failures,
+                                                                                     self._backoff))
+            return True
+
+    def add_recovery(self, duration):
+        with self._lock:
+            self.recoveries += 1
+            self.recovery_time += duration
+
+    def status(self):
+        with self._lock:
+            return {
+                'state': self.state,
+                'faults': self.faults,
+                'trips': self.trips,
+                'backoff': self._backoff,
+                'recoveries': self.recoveries,
+                'recovery_time': self.recovery_time,
+            }
+
+
+class RecoveryWorker(threading.Thread):
+    """Runs sensor recovery actions one at a time, away from the sampling threads. A sensor that already has a
+       recovery queued or running is not queued again."""
+
+    def __init__(self):
+        super().__init__(name="sensor-recovery", daemon=True)
+        self._queue = queue.Queue()
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def schedule(self, health, action):
+        with self._lock:
+            if health.name in self._pending:
+                return
+            self._pending.add(health.name)
+        self._queue.put((health, action))
+
+    def run(self):
+        while True:
+            health, action = self._queue.get()
+            start = time.monotonic()
+            try:
+                action()
+            except Exception as e:
+                logging.error("Recovery of sensor {} failed: {}".format(health.name, e))
+            finally:
+                health.add_recovery(time.monotonic() - start)
+                with self._lock:
+                    self._pending.discard(health.name)
@@ -0,0 +1,113 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+
+class BucketCache:
+    """Size bounded LRU cache of JSON values in an SQLite file, so all the web server processes share one cache. It is
+       meant for the sums of closed time buckets, which never change; a value is a cheap row to look up, so a request
+       only has to aggregate the buckets that are still open. The eviction order only needs to be rough, so a hit
+       records its use at most once every touch_interval seconds rather than writing on every lookup."""
+
+    def __init__(self, path, max_entries=200000, evict_every=100, touch_interval=600):
+        self._path = path
+        self._max_entries = max_entries
+        self._evict_every = evict_every
+        self._touch_interval = touch_interval
+        self._local = threading.local()
+        self._puts = 0
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self._path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, value TEXT, used REAL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS buckets_used ON buckets (used)")
+            self._local.connection = connection
+        return connection
+
+    def get_many(self, keys):
+        """The cached values of the keys that are in the cache"""
+        if not keys:
+            return {}
+        found = {}
+        stale = []
+        now = time.time()
+        try:
+            connection = self._connection()
+            keys = list(keys)
+            # Stay below SQLite's limit on the number of parameters
+            for i in range(0, len(keys), 500):
+                part = keys[i:i + 500]
+                rows = connection.execute("SELECT key, value, used FROM buckets WHERE key IN ({})".format(
+                    ",".join("?" * len(part))), part)
+                for key, value, used in rows:
+                    found[key] = json.loads(value)
+                    if used is None or used < now - self._touch_interval:
+                        stale.append(key)
+        except sqlite3.Error as e:
+            logging.error("Bucket cache lookup failed: {}".format(e))
+            return found
+        if stale:
+            self._touch(connection, stale, now)
+        return found
+
+    def _touch(self, connection, keys, now):
+        """Record the use of the keys for the eviction order"""
+        try:
+            with connection:
+                connection.execute("BEGIN")
+                connection.executemany("UPDATE buckets SET used = ? WHERE key = ?", [(now, key) for key in keys])
+        except sqlite3.OperationalError as e:
+            # Busy or locked by another process: the hits are still good, the recency can wait for the next one
+            logging.debug("Bucket cache could not record use: {}".format(e))
+
+    def put_many(self, items):
+        """Store (key, value) pairs"""
+        items = list(items)
+        if not items:
+            return
+        now = time.time()
+        try:
+            connection = self._connection()
+            connection.executemany("INSERT OR REPLACE INTO buckets (key, value, used) VALUES (?, ?, ?)",
+                                   [(key, json.dumps(value), now) for key, value in items])
+            with self._lock:
+                self._puts += len(items)
+                evict = self._puts >= self._evict_every
+                if evict:
+                    self._puts = 0
+            if evict:
+                self._evict(connection)
+        except sqlite3.Error as e:
+            logging.error("Bucket cache update failed: {}".format(e))
+
+    def _evict(self, connection):
+        count = connection.execute("SELECT COUNT(*) FROM buckets").fetchone()[0]
+        if count > self._max_entries:
+            connection.execute("DELETE FROM buckets WHERE key IN (SELECT key FROM buckets ORDER BY used LIMIT ?)",
+                               (count - self._max_entries,))
+
+
+if __name__ == '__main__':
+    import os
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as directory:
+        cache = BucketCache(os.path.join(directory, 'cache.sqlite'), max_entries=10, evict_every=1,
+                            touch_interval=0)
+        cache.put_many(("k{}".format(i), [i, i * 2.5]) for i in range(10))
+        assert cache.get_many(["k3", "k9", "x"]) == {"k3": [3, 7.5], "k9": [9, 22.5]}
+        time.sleep(0.01)
+        # Touched keys survive eviction
+        cache.get_many(["k0"])
+        time.sleep(0.01)
+        cache.put_many([("k10", None)])
+        assert cache.get_many(["k0", "k10"]) == {"k0": [0, 0], "k10": None}
+        assert len(cache.get_many("k{}".format(i) for i in range(11))) == 10
+        print("ok")
@@ -0,0 +1,69 @@
+import numpy
+
+
+def lttb(x, y, threshold):
+    """Largest-Triangle-Three-Buckets: the threshold points of (x, y), sorted on x, that keep the shape of the line,
+       spikes included. The first and last points are always kept; of every bucket in between the point is picked
+       that makes the largest triangle with the point picked before it and the average of the next bucket."""
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return x, y
+    # The n - 2 points in between are split into threshold - 2 buckets: [bounds[j], bounds[j + 1])
+    bounds = (numpy.arange(threshold - 1) * ((n - 2) / (threshold - 2))).astype(numpy.int64) + 1
+    bounds[-1] = n - 1
+    counts = numpy.diff(bounds)
+    avg_x = numpy.add.reduceat(x[:n - 1], bounds[:-1]) / counts
+    avg_y = numpy.add.reduceat(y[:n - 1], bounds[:-1]) / counts
+    # The point after the last bucket is the last point
+    avg_x = numpy.append(avg_x[1:], x[-1])
+    avg_y = numpy.append(avg_y[1:], y[-1])
+
+    picked = numpy.empty(threshold, dtype=numpy.int64)
+    picked[0] = 0
+    picked[-1] = n - 1
+    a = 0
+    for j in range(threshold - 2):
+        lo, hi = bounds[j], bounds[j + 1]
+        xs = x[lo:hi]
+        ys = y[lo:hi]
+        area = numpy.abs((x[a] - avg_x[j]) * (ys - y[a]) - (x[a] - xs) * (avg_y[j] - y[a]))
+        a = lo + int(numpy.argmax(area))
+        picked[j + 1] = a
+    return x[picked], y[picked]
+
+
+def envelope(x, y, start, step, count):
+    """The minimum and maximum of y in count buckets of step wide from start, for x sorted; NaN for empty buckets"""
+    minimum = numpy.full(count, numpy.nan)
+    maximum = numpy.full(count, numpy.nan)
+    if len(x) == 0 or count == 0:
+        return minimum, maximum
+    index = numpy.clip((x - start) // step, 0, count - 1).astype(numpy.int64)
+    # x is sorted, so every bucket is one run of points
+    firsts = numpy.flatnonzero(numpy.r_[True, index[1:] != index[:-1]])
+    minimum[index[firsts]] = numpy.minimum.reduceat(y, firsts)
+    maximum[index[firsts]] = numpy.maximum.reduceat(y, firsts)
+    return minimum, maximum
+
+
+if __name__ == '__main__':
+    rng = numpy.random.default_rng(1)
+    x = numpy.cumsum(rng.integers(20, 60, 100000)).astype(numpy.float64)
+    y = rng.normal(10, 1, len(x))
+    spike = 54321
+    y[spike] = 100
+    lx, ly = lttb(x, y, 500)
+    assert len(lx) == 500 and lx[0] == x[0] and lx[-1] == x[-1] and numpy.all(numpy.diff(lx) > 0)
+    # An averaged chart would lose the spike
+    assert 100 in ly
+    assert lttb(x[:10], y[:10], 500)[0].shape == (10,)
+
+    step = (x[-1] - x[0]) / 400 + 1
+    low, high = envelope(x, y, x[0], step, 400)
+    index = ((x - x[0]) // step).astype(int)
+    for b in (0, 17, int((x[spike] - x[0]) // step), 399):
+        assert low[b] == y[index == b].min() and high[b] == y[index == b].max()
+    assert numpy.nanmax(high) == 100
+    low, high = envelope(numpy.array([0.0, 5.0]), numpy.array([1.0, 2.0]), 0, 1, 3)
+    assert low[0] == 1 and numpy.isnan(low[1]) and high[2] == 2
+    print("ok")
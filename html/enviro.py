@@ -2,31 +2,71 @@ import sys
 import os
 
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import argparse
+import base64
+import csv
 import datetime
+import functools
+import io
 import json
+import logging
+import math
+import queue
+import tempfile
+import threading
+import time
 import traceback
-import numpy
 import tzlocal
 import dateutil.parser
+import numpy
 import pytz
-from astral.geocoder import lookup, database
-from astral.sun import sun
-from flask import Flask, render_template, request, session
+from flask import Flask, Response, render_template, request, session
+from pymongo.errors import ExecutionTimeout
 
+from bucket_cache import BucketCache
 from config import config
-from mongo_connector import MongoConnector
-
-mc = MongoConnector(config).get_collection()
+from downsample import envelope, lttb
+from mongo_connector import MongoConnector, query_deadline
+from ephemeris import get_ephemeris
+from live import LatestWatcher
+from planner import QueryPlanner
+from rollup import Rollups, from_millis, to_millis
+from sensor_types import types
+from sketch import Sketches
+from storage import MongoStorage, SQLiteStorage, StorageError
+import summarise
+
+if config.get('backend', 'mongo') == 'sqlite':
+    mongo = None
+    planner = None
+    # The file the collector in the directory above writes to
+    storage = SQLiteStorage(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..',
+                                         config.get('sqlite_file', 'enviro.sqlite')))
+    latest_watcher = LatestWatcher(storage)
+else:
+    mongo = MongoConnector(config)
+    mongo.ensure_indexes()
+    # Shared by all the server processes on this host
+    bucket_cache = BucketCache(config.get('cache_file', os.path.join(tempfile.gettempdir(), 'enviro_cache.sqlite')))
+    planner = QueryPlanner(mongo, Rollups(mongo.get_db(), config.get('rollup_prefix', 'rollup_')), bucket_cache,
+                           Sketches(mongo.get_db(), config.get('sketch_collection', 'sketches')))
+    storage = MongoStorage(mongo, planner=planner)
+    latest_watcher = LatestWatcher(storage, mongo.get_collection())
 app = Flask(__name__)
 app.secret_key = 'dummy stuff!'
+# Range queries get a few threads and connections of their own, so the fast routes never queue behind them
+heavy_queries = threading.BoundedSemaphore(config.get('heavy_queries', 4))
+# Every open live stream holds a thread, so there are only a few, and they are closed now and then; the browser
+# reconnects by itself
+live_streams = threading.BoundedSemaphore(config.get('live_streams', 4))
+# An export streams a whole cursor, so only a couple run at once, each with export_seconds of server time in all
+export_streams = threading.BoundedSemaphore(config.get('export_streams', 2))
 
 """
  The reducing and NH3 resistance readings will drop with increasing concentrations of the gases that they detect,
  and the oxidising sensor will increase with increasing levels of nitrogen dioxide
 """
 
-types = ["temperature", 'humidity', 'pressure', 'oxidising', 'reducing', 'nh3', "lux", "proximity", "pm1", "pm25",
-         "pm10", 'noise_low', 'noise_mid', 'noise_high']
 titles = {
     "temperature": "Temperature",
     'humidity': "Humidity",
@@ -42,6 +82,8 @@ titles = {
     'noise_low': "Noise Low",
     'noise_mid': "Noise Mid",
     'noise_high': "Noise High",
+    'noise_leq': "Noise Level (Leq)",
+    'noise_peak': "Noise Peak",
     'noise': "Noise (Combined)",
     "particles": "Particles (Combined)"
 }
@@ -61,6 +103,8 @@ units = {
     'noise_low': "",
     'noise_mid': "",
     'noise_high': '',
+    'noise_leq': "dBFS",
+    'noise_peak': "dBFS",
     'noise': "",
     "particles": "μg/m3"
 }
@@ -71,7 +115,8 @@ def update_session():
     selected = request.json.get('selected')
     tmp = {}
     for x, v in selected.items():
-        if x in session['selected']:
+        # Also types added after the session started
+        if x in titles:
             tmp[x] = v
     session['selected'] = tmp
     return json.dumps({'success': True}), 200, {'ContentType': 'application/json'}
@@ -85,6 +130,8 @@ def home_page():
             session['selected']['noise_low'] = 0
             session['selected']['noise_high'] = 0
             session['selected']['noise_mid'] = 0
+            session['selected']['noise_leq'] = 0
+            session['selected']['noise_peak'] = 0
             session['selected']['pm1'] = 0
             session['selected']['pm25'] = 0
             session['selected']['pm10'] = 0
@@ -153,20 +200,88 @@ def describe_type(rtype, value):
         return None
 
 
-@app.route("/latest/", methods=['POST', 'GET'])
-def latest_data():
-    res = mc.find().limit(1).sort("$natural", -1)
+def format_latest(res):
     data = dict()
     descriptions = dict()
     unit_list = dict()
     for i in types:
-        data[i] = res[0][i]
+        # Readings from before a type existed don't have it
+        data[i] = res.get(i)
         description = describe_type(i, data[i])
         if description is not None:
             descriptions[i] = description
         unit_list[i] = units[i]
 
-    return json.dumps({"data": data, 'description': descriptions, 'units': unit_list})
+    # Only the Mongo backend keeps the stale sensors of a reading
+    return json.dumps({"data": data, 'description': descriptions, 'units': unit_list, 'stale': res.get('stale', [])})
+
+
+def heavy(timeout):
+    """Decorator for the routes that run range queries: at most heavy_queries of them run at once, a request waits
+       for its turn for at most heavy_queue_timeout seconds (503 after that), and its queries get timeout seconds in
+       all, after which Mongo aborts them (504)"""
+    def decorate(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if not heavy_queries.acquire(timeout=config.get('heavy_queue_timeout', 10)):
+                return Response("Too many range queries running, try again later", status=503)
+            try:
+                with query_deadline(timeout):
+                    return f(*args, **kwargs)
+            finally:
+                heavy_queries.release()
+        return wrapper
+    return decorate
+
+
+@app.errorhandler(StorageError)
+def storage_error(e):
+    logging.error("Storage error: {}".format(e))
+    return Response("The storage can't be reached", status=503)
+
+
+@app.errorhandler(ExecutionTimeout)
+def query_timeout(e):
+    logging.warning("Query timed out: {}".format(e))
+    return Response("The query took too long", status=504)
+
+
+@app.route("/latest/", methods=['POST', 'GET'])
+def latest_data():
+    return format_latest(storage.latest())
+
+
+@app.route("/stream/latest")
+def stream_latest():
+    """Server-sent events with every new reading, in the same format as /latest/. At most live_streams are open at
+       once (503 after that, and the page polls /latest/ instead); a stream ends after live_stream_seconds."""
+    if not live_streams.acquire(blocking=False):
+        return Response("Too many live streams open, try again later", status=503)
+
+    def events():
+        deadline = time.monotonic() + config.get('live_stream_seconds', 300)
+        q = latest_watcher.subscribe()
+        try:
+            yield "retry: 1000\n\n"
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                try:
+                    reading = q.get(timeout=min(15, remaining))
+                except queue.Empty:
+                    # Keeps proxies from closing the connection
+                    yield ": keep-alive\n\n"
+                    continue
+                yield "data: {}\n\n".format(format_latest(reading))
+        finally:
+            latest_watcher.unsubscribe(q)
+
+    response = Response(events(), mimetype="text/event-stream",
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # Also when the client is gone before the stream started
+    response.call_on_close(live_streams.release)
+    return response
 
 
 def get_periods(interval, period):
@@ -193,29 +308,17 @@ def get_periods(interval, period):
     return start_time, end_time, interval
 
 
-def analyse_trend(rtype):
-    start_time, end_time, dummy = get_periods(0, '12hour')
-    mask = {"$and": [{"timestamp": {"$gte": start_time}}, {"timestamp": {"$lte": end_time}}]}
-    res = mc.find(mask, {"_id": 0, rtype: 1, "timestamp": 1})
-    data = []
-    ts = []
-    epoch = datetime.datetime.utcfromtimestamp(0)
-
-    for x in res:
-        data.append(x[rtype])
-        ts.append((x['timestamp'] - epoch).total_seconds())
-    line = numpy.polyfit(ts, data, 1, full=True)
-    slope = line[0][0]
-    intercept = line[0][1]
-    variance = numpy.var(data)
-    residuals = numpy.var([(slope * x + intercept - y) for x, y in zip(ts, data)])
-    r_squared = 1 - residuals / variance
+def analyse_trend(sums):
+    """Change per hour and trend arrow of the least squares line through the readings summed up in sums"""
+    line = sums.fit()
+    if line is None:
+        return 0, '-'
+    slope, intercept, r_squared = line
 
     # Calculate change in pressure per hour
     change_per_hour = slope * 60 * 60
     # variance_per_hour = variance * 60 * 60
 
-    # mean_pressure = numpy.mean(data)
     trend = '-'
     # Calculate trend
     if r_squared > 0.5:
@@ -234,64 +337,36 @@ def analyse_trend(rtype):
 
 
 @app.route("/details/", methods=["POST", "GET"])
+@heavy(15)
 def get_details():
-    orig_type = rtype = request.json.get('type', '')
+    rtype = request.json.get('type', '')
     interval = request.json.get('interval', 1)
     if rtype not in types:
         raise ValueError("Invalid type {}".format(rtype))
-    rtype = "${}".format(rtype)
     period = request.json.get('period', '').strip()
     start_time, end_time, interval = get_periods(interval, period)
-    mask = {"$and": [{"timestamp": {"$gte": start_time}}, {"timestamp": {"$lte": end_time}}]}
-    query = [
-        {"$match": {'$and': [mask]}},
-        {"$group": {
-            "_id": None,
-            "max": {"$max": rtype},
-            "min": {"$min": rtype},
-            "avg": {"$avg": rtype},
-            "std": {"$stdDevPop": rtype}
-        }
-        }
-    ]
-    change_per_hour, trend = analyse_trend(orig_type)
-    # print(change_per_hour, trend, orig_type)
-    res = mc.aggregate(query)
-    data = dict()
-    for x in res:
-        data = x
-        break
-    # print(data)
+    trend_start, trend_end, dummy = get_periods(0, '12hour')
+    # The statistics over the requested period and the 12 hour trend come out of the same aggregation
+    res = storage.range_sums(rtype, {'stats': (start_time, end_time), 'trend': (trend_start, trend_end)})
+    stats = res['stats']
+    variance = stats.sums.variance()
+    data = {
+        "max": stats.max,
+        "min": stats.min,
+        "avg": stats.sums.mean(),
+        "std": math.sqrt(variance) if variance is not None else None
+    }
+    # Percentiles from the quantile sketches, to within 1% of the exact value
+    for q, value in storage.quantiles(rtype, start_time, end_time, (0.5, 0.95, 0.99)).items():
+        data["p{}".format(round(q * 100))] = value
+    change_per_hour, trend = analyse_trend(res['trend'].sums)
     data['trend'] = trend
     data['change_per_hour'] = change_per_hour
     return json.dumps({"data": data})
 
 
 def calculate_next_sun(cityname, time_zone_name="UTC"):
-    city = lookup(cityname, database())
-    timezone = pytz.timezone(time_zone_name)
-    now = datetime.datetime.now(timezone)
-    local_now = now.astimezone(timezone)
-    yesterday = now - datetime.timedelta(days=1)
-    tomorrow = now + datetime.timedelta(days=1)
-    sun_today = sun(city.observer, date=local_now)
-    sun_yesterday = sun(city.observer, date=yesterday)
-    sun_tomorrow = sun(city.observer, date=tomorrow)
-    sunset_yesterday = sun_yesterday["sunset"]
-    sunrise_today = sun_today["sunrise"]
-    sunset_today = sun_today["sunset"]
-    sunrise_tomorrow = sun_tomorrow["sunrise"]
-    sunset_tomorrow = sun_tomorrow["sunset"]
-    if sunrise_today <= local_now:
-        next_sunrise = sunrise_tomorrow
-    else:
-        next_sunrise = sunrise_today
-
-    if sunset_today <= local_now:
-        next_sunset = sunset_tomorrow
-    else:
-        next_sunset = sunset_yesterday
-    return next_sunset.astimezone(timezone), next_sunrise.astimezone(timezone)
+    return get_ephemeris(cityname, time_zone_name).next_events()
 
 
 @app.route("/sun/", methods=["POST", "GET"])
@@ -300,80 +375,199 @@ def sun_info():
     return json.dumps({'sun_up': sun_up.strftime("%X"), "sun_down": sun_down.strftime("%X")})
 
 
-@app.route("/data/", methods=["POST", "GET"])
-def data_load():
-    orig_type = rtype = request.json.get('type', '')
-    interval = request.json.get('interval', 1)
-    if rtype not in types:
-        raise ValueError("Invalid type {}".format(rtype))
-    rtype = "${}".format(rtype)
-    period = request.json.get('period', '').strip()
-    start_time, end_time, interval = get_periods(interval, period)
-
-    mask = {"$and": [{"timestamp": {"$gte": start_time}}, {"timestamp": {"$lte": end_time}}]}
-    query = [
-        {
-            "$match": {
-                '$and': [mask]
-            }
-        },
-        {
-            "$group": {
-                "_id": {
-                    "$subtract": [
-                        {
-                            "$subtract": [
-                                "$timestamp", start_time
-                            ]
-                        },
-                        {
-                            "$mod": [
-                                {
-                                    "$subtract": [
-                                        "$timestamp", start_time
-                                    ]
-                                },
-                                1000 * interval
-                            ]
-                        }
-                    ]
-                },
-                'time': {'$min': "$timestamp"},
-                'time2': {'$max': "$timestamp"},
-                "avg": {"$avg": rtype}
-            }
-        },
-        {
-            "$sort": {"_id": 1}
-        }
-    ]
-
-    res = mc.aggregate(query)
-
-    data = []
+def load_series(rtypes, start_time, end_time, interval):
+    """Averages per interval of all the types in rtypes. Returns the labels and a list of values per type; only
+       intervals with a value for at least one type are included, missing values are None."""
+    buckets = storage.series(rtypes, start_time, end_time, interval)
     labels = []
+    series = {rtype: [] for rtype in rtypes}
     t_format = "%H:%M"
     if interval > 3600:
         t_format = "%Y-%m-%d %H:%M"
     local_tz = tzlocal.get_localzone()
-    for x in res:
-        t = x['time'].replace(tzinfo=pytz.UTC).astimezone(local_tz)
-        ts = t.strftime(t_format)
-        if x['avg'] is not None:
-            labels.append(ts)
-            data.append(round(x['avg'], 2))
+    for key in sorted(buckets):
+        x = buckets[key]
+        if all(x["{}_n".format(rtype)] == 0 for rtype in rtypes):
+            continue
+        t = from_millis(key).astimezone(local_tz)
+        labels.append(t.strftime(t_format))
+        for rtype in rtypes:
+            n = x["{}_n".format(rtype)]
+            series[rtype].append(round(x["{}_sum".format(rtype)] / n, 2) if n else None)
+    return labels, series
+
+
+def pack(values, dtype='<f4'):
+    """Base64 of the values as little endian numbers of dtype"""
+    return base64.b64encode(numpy.asarray(values).astype(dtype).tobytes()).decode('ascii')
+
+
+def pack_series(rtypes, start_time, end_time, interval):
+    """Averages per interval of all the types in rtypes on a fixed grid: the start of the first interval (ms since
+       the epoch), the step (ms) and per type the averages as base64 encoded little endian float32, NaN where an
+       interval has no readings"""
+    buckets = storage.series(rtypes, start_time, end_time, interval)
+    step = 1000 * interval
+    start = to_millis(start_time) // step * step
+    count = max(0, (to_millis(end_time) - start) // step + 1)
+    keys = numpy.fromiter(buckets.keys(), dtype=numpy.int64, count=len(buckets))
+    index = (keys - start) // step
+    series = {}
+    for rtype in rtypes:
+        sums = numpy.fromiter((x["{}_sum".format(rtype)] for x in buckets.values()), dtype=numpy.float64,
+                              count=len(buckets))
+        counts = numpy.fromiter((x["{}_n".format(rtype)] for x in buckets.values()), dtype=numpy.float64,
+                                count=len(buckets))
+        values = numpy.full(count, numpy.nan)
+        filled = counts > 0
+        values[index[filled]] = numpy.round(sums[filled] / counts[filled], 2)
+        series[rtype] = pack(values)
+    return start, step, count, series
+
+
+def downsample_series(rtypes, start_time, end_time, mode, width):
+    """Every reading of the types in rtypes reduced to about width points per type: with mode lttb the points
+       Largest-Triangle-Three-Buckets picks, as times (ms, float64) and values, and with mode envelope the minimum
+       and maximum per interval on a fixed grid like pack_series(). Either way spikes survive, unlike in averages."""
+    start = to_millis(start_time)
+    step = max(1000, -(-(to_millis(end_time) + 1 - start) // width))
+    count = max(0, (to_millis(end_time) - start) // step + 1)
+    res = {"mode": mode, "series": {}}
+    if mode == 'envelope':
+        res.update({"start": start, "step": step, "count": count})
+    for rtype in rtypes:
+        times, values = storage.points(rtype, start_time, end_time)
+        series = {"title": titles.get(rtype, ""), 'unit': units.get(rtype, "")}
+        if mode == 'lttb':
+            times, values = lttb(times, values, width)
+            series.update({"count": len(times), "times": pack(times, '<f8'), "values": pack(values)})
+        else:
+            minimum, maximum = envelope(times, values, start, step, count)
+            series.update({"min": pack(minimum), "max": pack(maximum)})
+        res["series"][rtype] = series
+    return res
 
-    title = titles[orig_type] if orig_type in titles else ""
-    unit = units[orig_type] if orig_type in units else ""
-    return json.dumps({"data": data, "labels": labels, "title": title, 'unit': unit})
+
+@app.route("/data/", methods=["POST", "GET"])
+@heavy(30)
+def data_load():
+    """The averages per interval of one type, or of a list of types sharing the labels. With "format": "columnar" the
+       values are packed on a fixed grid and the client makes the labels (see pack_series()). With "downsample":
+       "lttb" or "envelope" the readings themselves are reduced to about "width" points (see downsample_series())."""
+    rtypes = request.json.get('types')
+    single = rtypes is None
+    if single:
+        rtypes = [request.json.get('type', '')]
+    interval = request.json.get('interval', 1)
+    for rtype in rtypes:
+        if rtype not in types:
+            raise ValueError("Invalid type {}".format(rtype))
+    period = request.json.get('period', '').strip()
+    start_time, end_time, interval = get_periods(interval, period)
+
+    mode = request.json.get('downsample')
+    if mode is not None:
+        if mode not in ('lttb', 'envelope'):
+            raise ValueError("Invalid downsampling mode {}".format(mode))
+        width = min(max(int(request.json.get('width', 800)), 3), 4000)
+        return json.dumps(downsample_series(rtypes, start_time, end_time, mode, width))
+
+    if request.json.get('format') == 'columnar':
+        start, step, count, series = pack_series(rtypes, start_time, end_time, interval)
+        return json.dumps({"start": start, "step": step, "count": count, "series": {
+            rtype: {"values": series[rtype], "title": titles.get(rtype, ""), 'unit': units.get(rtype, "")}
+            for rtype in rtypes}})
+
+    labels, series = load_series(rtypes, start_time, end_time, interval)
+
+    if single:
+        rtype = rtypes[0]
+        return json.dumps({"data": series[rtype], "labels": labels, "title": titles.get(rtype, ""),
+                           'unit': units.get(rtype, "")})
+    return json.dumps({"labels": labels, "series": {
+        rtype: {"data": series[rtype], "title": titles.get(rtype, ""), 'unit': units.get(rtype, "")}
+        for rtype in rtypes}})
+
+
+@app.route('/export')
+def export_data():
+    """Stream the readings as NDJSON (the default) or CSV, one row at a time. Query parameters: fields (comma
+       separated, default all), after and before (ISO timestamps, exclusive), order (asc or desc) and limit. To page,
+       pass the timestamp of the last row as after (or as before, in descending order). At most export_streams run
+       at once (503 after that); Mongo stops a cursor after export_seconds, which cuts the export short."""
+    fields = request.args.get('fields')
+    fields = fields.split(',') if fields else types
+    for field in fields:
+        if field not in types:
+            raise ValueError("Invalid type {}".format(field))
+    after = request.args.get('after')
+    before = request.args.get('before')
+    after = dateutil.parser.isoparse(after).astimezone(pytz.UTC) if after else None
+    before = dateutil.parser.isoparse(before).astimezone(pytz.UTC) if before else None
+    descending = request.args.get('order', 'asc') == 'desc'
+    limit = request.args.get('limit', 0, type=int)
+    out_format = request.args.get('format', 'ndjson')
+    if out_format not in ['ndjson', 'csv']:
+        raise ValueError("Invalid format {}".format(out_format))
+
+    if not export_streams.acquire(blocking=False):
+        return Response("Too many exports running, try again later", status=503)
+    try:
+        with query_deadline(config.get('export_seconds', 300)):
+            cursor = storage.scan(fields, after, before, descending, limit)
+    except Exception:
+        export_streams.release()
+        raise
+
+    def timestamp(row):
+        return row['timestamp'].replace(tzinfo=pytz.UTC).isoformat()
+
+    def rows():
+        # Closing the cursor as soon as the client goes away frees it on the server
+        try:
+            yield from cursor
+        except ExecutionTimeout as e:
+            # The headers are sent already; all that is left is to end the export early
+            logging.warning("Export timed out: {}".format(e))
+        finally:
+            cursor.close()
+
+    def ndjson():
+        for row in rows():
+            row['timestamp'] = timestamp(row)
+            yield json.dumps(row) + "\n"
+
+    def csv_rows():
+        line = io.StringIO()
+        writer = csv.writer(line)
+        columns = ['timestamp'] + fields
+        writer.writerow(columns)
+        yield line.getvalue()
+        line.seek(0)
+        line.truncate()
+        for row in rows():
+            row['timestamp'] = timestamp(row)
+            writer.writerow([row.get(x) for x in columns])
+            yield line.getvalue()
+            line.seek(0)
+            line.truncate()
+
+    if out_format == 'csv':
+        response = Response(csv_rows(), mimetype='text/csv',
+                            headers={'Content-Disposition': 'attachment; filename=enviro.csv'})
+    else:
+        response = Response(ndjson(), mimetype='application/x-ndjson')
+    # Also when the client is gone before the export started
+    response.call_on_close(export_streams.release)
+    return response
 
 
 @app.route('/all/<int:count>')
 @app.route('/all/<name>/<int:count>')
+@heavy(15)
 def all_data(name='', count=1):
-    res = mc.find().skip(mc.count_documents({}) - count)
     data = []
-    for i in res:
+    for i in storage.latest_rows(count):
         if name == '':
             row = {
                 'temperature': i['temperature'],
@@ -401,4 +595,15 @@ def all_data(name='', count=1):
 
 
 if __name__ == "__main__":
-    app.run(host='0.0.0.0', port=4444, debug=True)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--audit", action='store_true',
+                        help="Check that every query the web app and the summariser make uses an index, then exit")
+    args = parser.parse_args()
+    if args.audit:
+        if mongo is None:
+            parser.error("The audit checks the Mongo queries; the backend is {}".format(config['backend']))
+        logging.basicConfig(level=logging.INFO)
+        mongo.audit(planner.query_shapes() + summarise.query_shapes(mongo))
+        print("All queries use an index")
+    else:
+        app.run(host='0.0.0.0', port=4444, debug=True, threaded=True)
@@ -0,0 +1,102 @@
+import logging
+import queue
+import threading
+import time
+
+import pymongo.errors
+
+from storage import StorageError
+
+
+class LatestWatcher:
+    """Watches the storage for new readings on a single thread and hands every new reading to all subscribers, so
+       the number of reads doesn't grow with the number of clients. Uses a change stream on the raw Mongo collection
+       where Mongo offers one (replica sets only) and otherwise polls for the newest reading every poll_interval
+       seconds, but only while anyone is subscribed."""
+
+    def __init__(self, storage, collection=None, poll_interval=5, retry_interval=30, queue_size=10):
+        self._storage = storage
+        self._collection = collection
+        self._poll_interval = poll_interval
+        self._retry_interval = retry_interval
+        self._queue_size = queue_size
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._subscribed = threading.Event()
+        self._thread = None
+        self._latest = None
+
+    def subscribe(self):
+        """A queue that receives every new reading, starting with the newest one known"""
+        q = queue.Queue(self._queue_size)
+        with self._lock:
+            self._subscribers.add(q)
+            self._subscribed.set()
+            if self._latest is not None:
+                q.put_nowait(self._latest)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="latest-watcher", daemon=True)
+                self._thread.start()
+        return q
+
+    def unsubscribe(self, q):
+        with self._lock:
+            self._subscribers.discard(q)
+            if not self._subscribers:
+                self._subscribed.clear()
+
+    def _publish(self, reading):
+        with self._lock:
+            # Replayed readings can come in late; only pass on newer ones
+            if self._latest is not None and reading['timestamp'] <= self._latest['timestamp']:
+                return
+            self._latest = reading
+            for q in self._subscribers:
+                try:
+                    q.put_nowait(reading)
+                except queue.Full:
+                    # A slow client only misses the older readings
+                    try:
+                        q.get_nowait()
+                    except queue.Empty:
+                        pass
+                    q.put_nowait(reading)
+
+    def _run(self):
+        use_change_stream = self._collection is not None
+        while True:
+            self._subscribed.wait()
+            try:
+                if use_change_stream:
+                    self._watch()
+                else:
+                    self._poll()
+            except pymongo.errors.OperationFailure as e:
+                if use_change_stream:
+                    logging.info("No change streams ({}); polling for new readings instead".format(e))
+                    use_change_stream = False
+                    continue
+                logging.error("Watching for new readings failed: {}".format(e))
+                time.sleep(self._retry_interval)
+            except (pymongo.errors.PyMongoError, StorageError) as e:
+                logging.error("Watching for new readings failed: {}".format(e))
+                time.sleep(self._retry_interval)
+
+    def _latest_reading(self):
+        reading = self._storage.latest()
+        if reading is not None:
+            self._publish(reading)
+
+    def _watch(self):
+        with self._collection.watch([{"$match": {"operationType": "insert"}}], max_await_time_ms=1000) as stream:
+            # Anything inserted before the stream opened is caught by this
+            self._latest_reading()
+            while self._subscribed.is_set():
+                change = stream.try_next()
+                if change is not None:
+                    self._publish(change['fullDocument'])
+
+    def _poll(self):
+        while self._subscribed.is_set():
+            self._latest_reading()
+            time.sleep(self._poll_interval)
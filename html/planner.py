@@ -0,0 +1,394 @@
+import datetime
+import itertools
+
+import numpy
+import pytz
+import tzlocal
+
+from mongo_connector import deadline_options
+from range_stats import RangeStatistics
+from rollup import HOUR_MS, to_millis, from_millis
+from sensor_types import types
+from sketch import ALPHA, QuantileSketch
+from summarise import DEFAULT_COUNT
+from trend import RangeSums, RegressionSums
+
+
+def series_pipeline(mask, interval, sums):
+    """Aggregation that adds up the sums per interval, aligned to multiples of the interval since the epoch; sums maps
+       a type to its (value, count) expressions"""
+    group = {
+        "_id": {
+            "$subtract": [
+                {"$toLong": "$timestamp"},
+                {"$mod": [{"$toLong": "$timestamp"}, 1000 * interval]}
+            ]
+        },
+    }
+    for rtype, (value, count) in sums.items():
+        group["{}_sum".format(rtype)] = {"$sum": value}
+        group["{}_n".format(rtype)] = {"$sum": count}
+    return [
+        {
+            "$match": {
+                '$and': [mask]
+            }
+        },
+        {
+            "$group": group
+        },
+    ]
+
+
+class QueryPlanner:
+    """Answers queries over any time range from wherever the readings are kept: the rollup tiers from the time they
+       start, the raw collection from the oldest reading the summariser left in it, and the hourly averages before
+       that. Hourly averages are weighted by the number of readings behind them; rows written before the count was
+       stored are taken to stand for default_count readings (an hour of readings 5 seconds apart)."""
+
+    def __init__(self, mongo, rollups=None, cache=None, sketches=None, default_count=DEFAULT_COUNT, settle=60):
+        self._raw = mongo.get_collection()
+        self._hourly = mongo.get_aggregate_collection()
+        self._rollups = rollups
+        self._sketches = sketches
+        self._cache = cache
+        self._default_count = default_count
+        self._settle = settle
+        self._range_stats = RangeStatistics(self._raw, rollups, cache=cache, settle=settle)
+        self._local_tz = tzlocal.get_localzone()
+
+    def raw_collection(self):
+        return self._raw
+
+    def cutoff(self):
+        """Time (ms) from which the raw collection or the rollup tiers hold every reading; the hourly averages are
+           used before it"""
+        first = self._raw.find_one({}, {"timestamp": 1}, sort=[("timestamp", 1)])
+        cutoff = to_millis(first['timestamp']) if first is not None else None
+        since = self._rollups.covered_from() if self._rollups is not None else None
+        if since is not None and (cutoff is None or since < cutoff):
+            cutoff = since
+        return cutoff
+
+    def _hour_start(self, row):
+        """Start of the hour of a summarised row (ms). Rows without a count were stored with the local time of the
+           hour as if it was UTC."""
+        t = row['timestamp']
+        if 'count' in row:
+            return to_millis(t)
+        t = t.replace(tzinfo=None)
+        if hasattr(self._local_tz, 'localize'):
+            t = self._local_tz.localize(t)
+        else:
+            t = t.replace(tzinfo=self._local_tz)
+        return to_millis(t.astimezone(pytz.UTC))
+
+    def _hourly_rows(self, rtypes, start, end):
+        """(hour start, count, row) of the hourly rows overlapping [start, end) (ms)"""
+        # Old rows can be off by the UTC offset, so look a day either side
+        margin = datetime.timedelta(days=1)
+        query = {"timestamp": {"$gte": from_millis(start) - margin, "$lt": from_millis(end) + margin}}
+        projection = dict({"timestamp": 1, "count": 1}, **{rtype: 1 for rtype in rtypes})
+        for row in self._hourly.find(query, projection, **deadline_options()):
+            hour = self._hour_start(row)
+            if hour < end and hour + HOUR_MS > start:
+                yield hour, row.get('count', self._default_count), row
+
+    @staticmethod
+    def _clip(hour, count, start, end):
+        """The part of an hour inside [start, end) and the share of its readings that falls in it"""
+        first = max(hour, start)
+        last = min(hour + HOUR_MS, end)
+        return first, last, count * (last - first) / HOUR_MS
+
+    @staticmethod
+    def _raw_series_pipeline(rtypes, interval, lower, upper):
+        mask = {"$and": [{"timestamp": {"$gte": lower}}, {"timestamp": upper}]}
+        numeric = ["double", "int", "long", "decimal"]
+        sums = {rtype: ("${}".format(rtype), {"$cond": [{"$in": [{"$type": "${}".format(rtype)}, numeric]}, 1, 0]})
+                for rtype in rtypes}
+        return series_pipeline(mask, interval, sums)
+
+    @staticmethod
+    def _tier_series_pipeline(rtypes, interval, lower, upper):
+        # The _id of a rollup bucket is its start time; only whole buckets before upper
+        mask = {"_id": {"$gte": lower, "$lt": upper}}
+        sums = {rtype: ("${}.sy".format(rtype), "${}.n".format(rtype)) for rtype in rtypes}
+        return series_pipeline(mask, interval, sums)
+
+    def series(self, rtypes, start_time, end_time, interval):
+        """Sums and counts per interval of every type: {interval start (ms): {'<type>_sum': ..., '<type>_n': ...}}.
+           The intervals are aligned to multiples of the interval since the epoch, starting with the one start_time is
+           in. Intervals that closed a while ago don't change any more, so their sums are cached; only the intervals
+           after the last cached one are aggregated."""
+        size = 1000 * interval
+        start_ms = to_millis(start_time) // size * size
+        end_ms = to_millis(end_time)
+        now = to_millis(datetime.datetime.now(pytz.UTC))
+        closed_end = min((now - self._settle * 1000) // size * size, (end_ms + 1) // size * size)
+        closed = range(start_ms, max(closed_end, start_ms), size)
+
+        cached = {}
+        cache_keys = {}
+        if self._cache is not None:
+            generation = self._rollups.generation() if self._rollups is not None else 0
+            cache_keys = {(rtype, key): "series:{}:{}:{}:{}".format(generation, rtype, interval, key)
+                          for key in closed for rtype in rtypes}
+            cached = self._cache.get_many(cache_keys.values())
+        lower = next((key for key in closed if any(cache_keys.get((rtype, key)) not in cached for rtype in rtypes)),
+                     closed.stop)
+
+        buckets = {}
+        for key in range(start_ms, lower, size):
+            bucket = buckets[key] = {}
+            for rtype in rtypes:
+                bucket["{}_sum".format(rtype)], bucket["{}_n".format(rtype)] = cached[cache_keys[(rtype, key)]]
+        if lower <= end_ms:
+            fetched = self._aggregate_series(rtypes, lower, end_time, interval)
+            buckets.update(fetched)
+            if self._cache is not None:
+                items = []
+                for key in range(lower, closed.stop, size):
+                    bucket = fetched.get(key, {})
+                    items += [(cache_keys[(rtype, key)], [bucket.get("{}_sum".format(rtype), 0),
+                                                          bucket.get("{}_n".format(rtype), 0)]) for rtype in rtypes]
+                self._cache.put_many(items)
+        return buckets
+
+    def _aggregate_series(self, rtypes, start_ms, end_time, interval):
+        """Sums per interval from start_ms (the start of an interval) up to and including end_time"""
+        end_ms = to_millis(end_time)
+        size = 1000 * interval
+        buckets = {}
+
+        def add(x):
+            bucket = buckets.get(x['_id'])
+            if bucket is None:
+                buckets[x['_id']] = x
+                return
+            for rtype in rtypes:
+                for key in ["{}_sum".format(rtype), "{}_n".format(rtype)]:
+                    bucket[key] += x[key]
+
+        # Before the cutoff from the hourly averages
+        lower = start_ms
+        cutoff = self.cutoff()
+        if cutoff is None or cutoff > start_ms:
+            upper = min(cutoff, end_ms + 1) if cutoff is not None else end_ms + 1
+            for hour, count, row in self._hourly_rows(rtypes, start_ms, upper):
+                first, last, count = self._clip(hour, count, start_ms, upper)
+                x = {'_id': first // size * size}
+                for rtype in rtypes:
+                    value = row.get(rtype)
+                    x["{}_sum".format(rtype)] = value * count if value is not None else 0
+                    x["{}_n".format(rtype)] = count if value is not None else 0
+                add(x)
+            lower = upper
+        if lower > end_ms:
+            return buckets
+
+        # Then from the raw readings, except for the whole buckets of the tier from the time the rollups cover; the
+        # bucket end_time falls in has readings after it, so that one comes from the raw readings as well
+        tier_start = tier_end = end_ms + 1
+        resolution = self._rollups.resolution_for(interval) if self._rollups is not None else None
+        since = self._rollups.covered_from() if resolution is not None else None
+        if since is not None:
+            tier_size = resolution * 1000
+            tier_start = max(-(-max(lower, since) // tier_size) * tier_size, lower)
+            tier_end = max((end_ms + 1) // tier_size * tier_size, tier_start)
+
+        raw = []
+        if tier_start < tier_end:
+            if tier_start > lower:
+                raw.append((lower, {"$lt": from_millis(tier_start)}))
+            if tier_end <= end_ms:
+                raw.append((tier_end, {"$lte": end_time}))
+        else:
+            raw.append((lower, {"$lte": end_time}))
+        results = []
+        for first, upper in raw:
+            pipeline = self._raw_series_pipeline(rtypes, interval, from_millis(first), upper)
+            results.append(self._raw.aggregate(pipeline, **deadline_options(aggregate=True)))
+        if tier_start < tier_end:
+            pipeline = self._tier_series_pipeline(rtypes, interval, from_millis(tier_start), from_millis(tier_end))
+            collection = self._rollups.collection(resolution)
+            results.append(collection.aggregate(pipeline, **deadline_options(aggregate=True)))
+        for res in results:
+            for x in res:
+                add(x)
+        return buckets
+
+    def range_sums(self, rtype, ranges):
+        """ranges maps a name to a (start, end) pair of UTC datetimes, end inclusive. Returns a RangeSums per name
+           with x measured in seconds from the start of that range. Hours before the cutoff count as their number of
+           readings at the middle of the hour (of the part inside the range), all at the hourly average, so the spread
+           within those hours is lost."""
+        cutoff = self.cutoff()
+        recent = {}
+        old = {}
+        for name, (start, end) in ranges.items():
+            start_ms = to_millis(start)
+            end_ms = to_millis(end)
+            if cutoff is not None and cutoff <= end_ms:
+                recent[name] = (max(start, from_millis(cutoff)), end)
+            if cutoff is None or cutoff > start_ms:
+                old[name] = (start_ms, min(cutoff, end_ms + 1) if cutoff is not None else end_ms + 1)
+
+        results = self._range_stats.query(rtype, recent) if recent else {}
+        for name, (start, end) in ranges.items():
+            result = results.setdefault(name, RangeSums())
+            if name not in recent:
+                continue
+            offset = (to_millis(recent[name][0]) - to_millis(start)) / 1000
+            if offset:
+                # x of the recent part is measured from the cutoff
+                results[name] = RangeSums().merge(result, offset)
+        if old:
+            lo = min(start for start, end in old.values())
+            hi = max(end for start, end in old.values())
+            for hour, hour_count, row in self._hourly_rows([rtype], lo, hi):
+                y = row.get(rtype)
+                if y is None:
+                    continue
+                for name, (start, end) in old.items():
+                    first, last, count = self._clip(hour, hour_count, start, end)
+                    if first >= last:
+                        continue
+                    x = ((first + last) / 2 - start) / 1000
+                    part = RangeSums(RegressionSums(count, count * x, count * y, count * x * y, count * x * x,
+                                                    count * y * y), y, y)
+                    results[name].merge(part)
+        return results
+
+    def quantiles(self, rtype, start_time, end_time, qs=(0.5, 0.95, 0.99)):
+        """The qs quantiles of rtype from start_time up to and including end_time, to within the relative accuracy of
+           the sketches (1%): the hourly sketches merged for the whole hours they cover and the raw readings of the
+           rest. Readings summarised before the sketches existed are left out. None per quantile without readings."""
+        sketch = QuantileSketch(self._sketches.alpha if self._sketches is not None else ALPHA)
+        start = to_millis(start_time)
+        end = to_millis(end_time) + 1
+        raw = [(start, end)]
+        since = self._sketches.covered_from() if self._sketches is not None else None
+        if since is not None and since < end:
+            size = self._sketches.resolution * 1000
+            first = -(-max(start, since) // size) * size
+            last = end // size * size
+            if first < last:
+                spec = self._sketches.query_spec(rtype, first, last)
+                for doc in self._sketches.collection().find(spec['filter'], spec['projection'], **deadline_options()):
+                    sketch.merge(doc[rtype])
+                raw = [(start, first), (last, end)]
+        raw = [(lo, hi) for lo, hi in raw if lo < hi]
+        if raw:
+            for x in self._raw.find(self._quantile_filter(rtype, raw), {"_id": 0, rtype: 1}, **deadline_options()):
+                sketch.add(x[rtype])
+        return {q: sketch.quantile(q) for q in qs}
+
+    @staticmethod
+    def _quantile_filter(rtype, ranges):
+        return {"$or": [{"timestamp": {"$gte": from_millis(lo), "$lt": from_millis(hi)}} for lo, hi in ranges],
+                rtype: {"$type": "number"}}
+
+    @staticmethod
+    def _scan_spec(fields, after=None, before=None, descending=False, limit=0):
+        query = {}
+        if after is not None:
+            query.setdefault("timestamp", {})["$gt"] = after
+        if before is not None:
+            query.setdefault("timestamp", {})["$lt"] = before
+        projection = dict({"_id": 0, "timestamp": 1}, **{field: 1 for field in fields})
+        return {'filter': query, 'projection': projection, 'sort': [("timestamp", -1 if descending else 1)],
+                'limit': limit}
+
+    def scan(self, fields, after=None, before=None, descending=False, limit=0, batch_size=1000):
+        """Cursor over the raw readings between after and before (both exclusive) in timestamp order, with only the
+           timestamp and the given fields. The next page starts after (or before) the timestamp of the last row. Under
+           a query_deadline() the cursor gets what is left of it for all its batches."""
+        spec = self._scan_spec(fields, after, before, descending, limit)
+        return self._raw.find(spec['filter'], spec['projection'], **deadline_options()).sort(spec['sort']).limit(
+            limit).batch_size(batch_size)
+
+    def points(self, rtype, start_time, end_time, batch_size=5000):
+        """The timestamps (ms) and values of rtype from start_time up to and including end_time as two NumPy arrays
+           sorted on time, read from a projection of the raw readings a batch at a time. Before the cutoff the
+           hourly averages, placed at the middle of their hour, stand in for the readings."""
+        start_ms = to_millis(start_time)
+        end_ms = to_millis(end_time)
+        times = []
+        values = []
+        lower = start_ms
+        cutoff = self.cutoff()
+        if cutoff is None or cutoff > start_ms:
+            upper = min(cutoff, end_ms + 1) if cutoff is not None else end_ms + 1
+            hours = sorted((hour, row[rtype]) for hour, _, row in self._hourly_rows([rtype], start_ms, upper)
+                           if row.get(rtype) is not None)
+            times.append(numpy.array([min(max(hour + HOUR_MS // 2, start_ms), upper - 1) for hour, _ in hours],
+                                     dtype=numpy.int64))
+            values.append(numpy.array([value for _, value in hours], dtype=numpy.float64))
+            lower = upper
+        if lower <= end_ms:
+            cursor = self._raw.find(self._points_filter(rtype, from_millis(lower), end_time),
+                                    {"_id": 0, "timestamp": 1, rtype: 1}, **deadline_options()).sort(
+                "timestamp", 1).batch_size(batch_size)
+            while True:
+                batch = [(x['timestamp'], x[rtype]) for x in itertools.islice(cursor, batch_size)]
+                if not batch:
+                    break
+                times.append(numpy.fromiter((to_millis(t) for t, _ in batch), dtype=numpy.int64, count=len(batch)))
+                values.append(numpy.fromiter((y for _, y in batch), dtype=numpy.float64, count=len(batch)))
+        if not times:
+            return numpy.empty(0, dtype=numpy.int64), numpy.empty(0)
+        return numpy.concatenate(times), numpy.concatenate(values)
+
+    @staticmethod
+    def _points_filter(rtype, lower, end_time):
+        return {"timestamp": {"$gte": lower, "$lte": end_time}, rtype: {"$type": "number"}}
+
+    def latest(self):
+        """The newest reading"""
+        return self._raw.find_one({}, sort=[("timestamp", -1)])
+
+    def latest_rows(self, count):
+        """The newest count readings, oldest first, topped up with hourly averages if the raw collection holds fewer"""
+        rows = list(self._raw.find(**deadline_options()).sort("timestamp", -1).limit(count))
+        if len(rows) < count:
+            hourly = []
+            for row in self._hourly.find(**deadline_options()).sort("timestamp", -1).limit(count - len(rows)):
+                row['timestamp'] = from_millis(self._hour_start(row))
+                hourly.append(row)
+            rows += hourly
+        rows.reverse()
+        return rows
+
+    def query_shapes(self, rtype='pressure'):
+        """An example of every query shape the planner issues, as (name, collection, kind, spec) for
+           MongoConnector.audit()"""
+        end = datetime.datetime.now(pytz.UTC)
+        start = end - datetime.timedelta(days=1)
+        shapes = [
+            ('latest', self._raw, 'find', {'sort': [("timestamp", -1)], 'limit': 1}),
+            ('cutoff', self._raw, 'find', {'projection': {"timestamp": 1}, 'sort': [("timestamp", 1)], 'limit': 1}),
+            ('latest rows', self._raw, 'find', {'sort': [("timestamp", -1)], 'limit': 100}),
+            ('latest hourly rows', self._hourly, 'find', {'sort': [("timestamp", -1)], 'limit': 100}),
+            ('hourly rows', self._hourly, 'find', {'filter': {"timestamp": {"$gte": start, "$lt": end}}}),
+            ('export', self._raw, 'find', self._scan_spec(types, start, end, limit=1000)),
+            ('points', self._raw, 'find', {'filter': self._points_filter(rtype, start, end),
+                                           'projection': {"_id": 0, "timestamp": 1, rtype: 1},
+                                           'sort': [("timestamp", 1)]}),
+            ('raw series', self._raw, 'aggregate',
+             self._raw_series_pipeline(types, 900, start, {"$lte": end})),
+        ]
+        shapes += self._range_stats.query_shapes(rtype, start, end)
+        if self._rollups is not None:
+            collection = self._rollups.collection(self._rollups.tiers[0])
+            shapes.append(('rollup series', collection, 'aggregate',
+                           self._tier_series_pipeline(types, 900, start, end)))
+        start_ms = to_millis(start)
+        end_ms = to_millis(end)
+        fringes = [(start_ms, start_ms + HOUR_MS), (end_ms - HOUR_MS, end_ms)]
+        shapes.append(('quantile readings', self._raw, 'find',
+                       {'filter': self._quantile_filter(rtype, fringes), 'projection': {"_id": 0, rtype: 1}}))
+        if self._sketches is not None:
+            shapes.append(('sketches', self._sketches.collection(), 'find',
+                           self._sketches.query_spec(rtype, start_ms, end_ms)))
+        return shapes
@@ -0,0 +1,170 @@
+import datetime
+
+import pytz
+
+from mongo_connector import deadline_options
+from rollup import to_millis, from_millis
+from trend import RangeSums, RegressionSums
+
+
+class RangeStatistics:
+    """Summary statistics and least squares regression sums of a reading type over one or more time ranges. As much
+       of the ranges as possible is covered with buckets from the rollup tiers, coarsest first; only the bits at the
+       edges that no tier bucket fits in, and any time from before the tiers, are aggregated from the raw readings,
+       in a single aggregation. A month then takes a few dozen rollup documents plus at most a couple of minutes of
+       readings on either side. With a cache, tier buckets that closed more than settle seconds ago are only read
+       once."""
+    _sum_fields = ('n', 'sx', 'sy', 'sxy', 'sxx', 'syy', 'min', 'max')
+
+    def __init__(self, collection, rollups=None, bucket_size=3600, cache=None, settle=60):
+        self._collection = collection
+        self._rollups = rollups
+        self._bucket_ms = bucket_size * 1000
+        self._cache = cache
+        self._settle = settle
+
+    def _pipeline(self, rtype, fetch, ranges):
+        bucket = {"$subtract": ["$timestamp", {"$mod": [{"$toLong": "$timestamp"}, self._bucket_ms]}]}
+        flags = {name: {"$and": [{"$gte": ["$timestamp", start]}, {"$lte": ["$timestamp", end]}]}
+                 for name, (start, end) in ranges.items()}
+        masks = []
+        for start, end in fetch:
+            masks.append({"timestamp": {"$gte": start, "$lt": end}})
+        group_id = {"b": "$b"}
+        group_id.update({"f_{}".format(name): "$f_{}".format(name) for name in ranges})
+        project = {"y": 1, "b": 1, "x": {"$divide": [{"$subtract": ["$timestamp", "$b"]}, 1000]}}
+        project.update({"f_{}".format(name): 1 for name in ranges})
+        return [
+            {"$match": {"$or": masks, rtype: {"$type": "number"}}},
+            {"$project": dict({"timestamp": 1, "y": "${}".format(rtype), "b": bucket},
+                              **{"f_{}".format(name): flag for name, flag in flags.items()})},
+            {"$project": project},
+            {"$group": {
+                "_id": group_id,
+                "n": {"$sum": 1},
+                "sx": {"$sum": "$x"},
+                "sy": {"$sum": "$y"},
+                "sxy": {"$sum": {"$multiply": ["$x", "$y"]}},
+                "sxx": {"$sum": {"$multiply": ["$x", "$x"]}},
+                "syy": {"$sum": {"$multiply": ["$y", "$y"]}},
+                "min": {"$min": "$y"},
+                "max": {"$max": "$y"},
+            }},
+        ]
+
+    def query_shapes(self, rtype, start, end):
+        """An example of the queries behind query(), as (name, collection, kind, spec) for MongoConnector.audit()"""
+        shapes = [('range statistics', self._collection, 'aggregate',
+                   self._pipeline(rtype, [(start, end)], {'range': (start, end)}))]
+        if self._rollups is not None:
+            collection = self._rollups.collection(self._rollups.tiers[0])
+            shapes.append(('rollup buckets', collection, 'find',
+                           {'filter': {"$or": [{"_id": {"$gte": start, "$lt": end}}], rtype: {"$exists": True}},
+                            'projection': {rtype: 1}}))
+        return shapes
+
+    def _cover(self, start, end, tiers, pieces, raw):
+        """Split [start, end) into the largest aligned runs of buckets of the tiers (coarsest first) and raw bits"""
+        for i, resolution in enumerate(tiers):
+            size = resolution * 1000
+            first = -(-start // size) * size
+            last = end // size * size
+            if first < last:
+                pieces.setdefault(resolution, []).append((first, last))
+                self._cover(start, first, tiers[i + 1:], pieces, raw)
+                self._cover(last, end, tiers[i + 1:], pieces, raw)
+                return
+        if start < end:
+            raw.append((start, end))
+
+    def _plan(self, bounds):
+        """Rollup pieces per tier and raw bits that together cover every range in bounds exactly once"""
+        edges = sorted(set(x for bound in bounds.values() for x in bound))
+        since = self._rollups.covered_from() if self._rollups is not None else None
+        tiers = list(reversed(self._rollups.tiers)) if self._rollups is not None else []
+        pieces = {}
+        raw = []
+        for start, end in zip(edges, edges[1:]):
+            if not any(lo <= start and end <= hi for lo, hi in bounds.values()):
+                continue
+            if since is None or since >= end:
+                raw.append((start, end))
+                continue
+            if since > start:
+                raw.append((start, since))
+                start = since
+            self._cover(start, end, tiers, pieces, raw)
+        merged = []
+        for start, end in sorted(raw):
+            if merged and merged[-1][1] == start:
+                merged[-1] = (merged[-1][0], end)
+            else:
+                merged.append((start, end))
+        return pieces, merged
+
+    def _tier_buckets(self, rtype, resolution, runs, generation):
+        """The sums of rtype in the tier buckets that make up the runs: {bucket start (ms): [n, Σx, Σy, Σxy, Σx², Σy²,
+           min, max]}, from the cache where possible"""
+        size = resolution * 1000
+        found = {}
+        keys = {}
+        fetch = runs
+        if self._cache is not None:
+            now = to_millis(datetime.datetime.now(pytz.UTC))
+            closed_end = (now - self._settle * 1000) // size * size
+            keys = {b: "tier:{}:{}:{}:{}".format(generation, rtype, resolution, b)
+                    for start, end in runs for b in range(start, min(end, closed_end), size)}
+            cached = self._cache.get_many(keys.values())
+            found = {b: cached[key] for b, key in keys.items() if key in cached}
+            # Only the runs of buckets that weren't cached
+            fetch = []
+            for start, end in runs:
+                for b in range(start, end, size):
+                    if b in found:
+                        continue
+                    if fetch and fetch[-1][1] == b:
+                        fetch[-1] = (fetch[-1][0], b + size)
+                    else:
+                        fetch.append((b, b + size))
+
+        fetched = {}
+        if fetch:
+            query = {"$or": [{"_id": {"$gte": from_millis(start), "$lt": from_millis(end)}} for start, end in fetch],
+                     rtype: {"$exists": True}}
+            for x in self._rollups.collection(resolution).find(query, {rtype: 1}, **deadline_options()):
+                fetched[to_millis(x['_id'])] = [x[rtype][name] for name in self._sum_fields]
+            if keys:
+                # Empty buckets are cached too, as None
+                self._cache.put_many((keys[b], fetched.get(b)) for start, end in fetch for b in range(start, end, size)
+                                     if b in keys)
+        found.update(fetched)
+        return {b: y for b, y in found.items() if y is not None}
+
+    def query(self, rtype, ranges):
+        """ranges maps a name to a (start, end) pair of UTC datetimes, end inclusive. Returns a RangeSums per name
+           with x measured in seconds from the start of that range."""
+        # Half open ranges in milliseconds
+        bounds = {name: (to_millis(start), to_millis(end) + 1) for name, (start, end) in ranges.items()}
+        pieces, raw = self._plan(bounds)
+        results = {name: RangeSums() for name in ranges}
+
+        generation = self._rollups.generation() if pieces and self._cache is not None else 0
+        for resolution, runs in pieces.items():
+            size = resolution * 1000
+            for b_start, y in self._tier_buckets(rtype, resolution, runs, generation).items():
+                part = RangeSums(RegressionSums(*y[:6]), y[6], y[7])
+                for name, (start, end) in bounds.items():
+                    if start <= b_start and b_start + size <= end:
+                        results[name].merge(part, (b_start - start) / 1000)
+
+        if raw:
+            fetch = [(from_millis(start), from_millis(end)) for start, end in raw]
+            pipeline = self._pipeline(rtype, fetch, ranges)
+            for x in self._collection.aggregate(pipeline, **deadline_options(aggregate=True)):
+                b_start = to_millis(x['_id']['b'])
+                part = RangeSums(RegressionSums(x['n'], x['sx'], x['sy'], x['sxy'], x['sxx'], x['syy']),
+                                 x['min'], x['max'])
+                for name in ranges:
+                    if x['_id']['f_{}'.format(name)]:
+                        results[name].merge(part, (b_start - bounds[name][0]) / 1000)
+        return results
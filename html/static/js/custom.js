@@ -22,6 +22,83 @@ function get_period()
     return [period, interval];
 }
 
+function two_digits(n)
+{
+    return (n < 10 ? '0' : '') + n;
+}
+
+function format_label(t, with_date)
+{
+    var d = new Date(t);
+    var label = two_digits(d.getHours()) + ':' + two_digits(d.getMinutes());
+    if (with_date) {
+        label = d.getFullYear() + '-' + two_digits(d.getMonth() + 1) + '-' + two_digits(d.getDate()) + ' ' + label;
+    }
+    return label;
+}
+
+function decode_view(packed)
+{
+    var bytes = atob(packed);
+    var view = new DataView(new ArrayBuffer(bytes.length));
+    for (var i = 0; i < bytes.length; i++) {
+        view.setUint8(i, bytes.charCodeAt(i));
+    }
+    return view;
+}
+
+function decode_values(packed, count)
+{
+    // Little endian float32, NaN where there is no value
+    var view = decode_view(packed);
+    var values = new Array(count);
+    for (var i = 0; i < count; i++) {
+        var v = view.getFloat32(i * 4, true);
+        values[i] = isNaN(v) ? null : Math.round(v * 100) / 100;
+    }
+    return values;
+}
+
+function decode_times(packed, count)
+{
+    // Little endian float64 milliseconds since the epoch
+    var view = decode_view(packed);
+    var times = new Array(count);
+    for (var i = 0; i < count; i++) {
+        times[i] = view.getFloat64(i * 8, true);
+    }
+    return times;
+}
+
+function load_series(types, period, interval, callback)
+{
+    // Fetches the averages in the columnar format and calls back with the labels and a data list per type, leaving
+    // out the intervals without any values
+    $.ajax({
+        url: script_root + '/data/',
+        type: 'POST',
+        data: JSON.stringify({'types': types, 'period': period, 'interval': interval, 'format': 'columnar'}),
+        cache: false,
+        contentType: "application/json;charset=UTF-8",
+    }).done(function(data) {
+        var res = JSON.parse(data);
+        var columns = types.map(function(type) { return decode_values(res.series[type].values, res.count); });
+        var labels = [];
+        var series = {};
+        for (var j = 0; j < types.length; j++) {
+            series[types[j]] = {data: [], title: res.series[types[j]].title, unit: res.series[types[j]].unit};
+        }
+        for (var i = 0; i < res.count; i++) {
+            if (columns.every(function(column) { return column[i] === null; })) { continue; }
+            labels.push(format_label(res.start + i * res.step, res.step > 3600 * 1000));
+            for (var j = 0; j < types.length; j++) {
+                series[types[j]].data.push(columns[j][i]);
+            }
+        }
+        callback({labels: labels, series: series});
+    });
+}
+
 function load_composite_graph(canvas_id, types, title)
 {
     var x = get_period();
@@ -49,40 +126,29 @@ function load_composite_graph(canvas_id, types, title)
         fmtYLabel: "number",
     };
 
-    var labels = null;
-    for (var i=0 ; i < types.length; i++) {
-        $.ajax({
-                url: script_root + '/data/',
-                type: 'POST',
-                data: JSON.stringify({'type': types[i], 'period': period, 'interval': interval}),
-                cache: false,
-                async: false,
-                contentType: "application/json;charset=UTF-8",
-        }).done(function(data) {
-            var res = JSON.parse(data);
-            var interval_size = calculate_yaxis(res.data) ;
-            if (res.labels.length > 0 && res.data.length > 0) {
-                res_data[i] = {
-                    type: "line",
-                    fillColor: colours[i],
-                    strokeColor: colours[i],
-                    data: res.data,
-                    title: types[i].replace(/_/g, " "),
-                    };
-                options['yAxisUnit'] = res.unit;
-                options['yAxisMinimumInterval'] = interval_size;
-            }
-//            console.log(res);
-            if (labels === null) {labels = res.labels;}
-        });
-    }
-
-    var data = {
-        labels: labels,
-        datasets: res_data
-    };
-//    console.log(data);
-    new Chart(document.getElementById(canvas_id).getContext("2d")).StackedBar(data, options);
+    load_series(types, period, interval, function(res) {
+        if (res.labels.length == 0) { return }
+        for (var i=0 ; i < types.length; i++) {
+            var series = res.series[types[i]];
+            var values = series.data.filter(function(v) { return v !== null; });
+            if (values.length == 0) { continue; }
+            res_data.push({
+                type: "line",
+                fillColor: colours[i],
+                strokeColor: colours[i],
+                data: series.data.map(function(v) { return v === null ? undefined : v; }),
+                title: types[i].replace(/_/g, " "),
+            });
+            options['yAxisUnit'] = series.unit;
+            options['yAxisMinimumInterval'] = calculate_yaxis(values);
+        }
+        var chart_data = {
+            labels: res.labels,
+            datasets: res_data
+        };
+//        console.log(chart_data);
+        new Chart(document.getElementById(canvas_id).getContext("2d")).StackedBar(chart_data, options);
+    });
     return false;
 }
 
@@ -133,19 +199,83 @@ function fmtChartJSPerso(n, p, fmt)
 }
 
 
-function load_graph(canvas_id, type)
+function load_downsampled_graph(canvas_id, type, period, interval, mode)
 {
-    var x= get_period();
-    var period = x[0];
-    var interval = x[1];
+    // Line chart of the readings themselves, reduced to about one point per pixel: the points picked by LTTB, or
+    // the lowest and highest reading per pixel, so short spikes stay visible
+    var canvas = document.getElementById(canvas_id);
     $.ajax({
         url: script_root + '/data/',
         type: 'POST',
-        data:  JSON.stringify({'type': type, 'period': period, 'interval': interval}),
+        data: JSON.stringify({'types': [type], 'period': period, 'interval': interval, 'downsample': mode,
+            'width': canvas.width}),
         cache: false,
         contentType: "application/json;charset=UTF-8",
     }).done(function(data) {
         var res = JSON.parse(data);
+        var series = res.series[type];
+        var labels = [];
+        var datasets = [];
+        var values = [];
+        if (mode == 'lttb') {
+            var times = decode_times(series.times, series.count);
+            values = decode_values(series.values, series.count);
+            var with_date = times.length > 1 && times[times.length - 1] - times[0] > 86400 * 1000;
+            labels = times.map(function(t) { return format_label(t, with_date); });
+            datasets.push({strokeColor: colours[0], data: values, title: type});
+        } else {
+            var minimum = decode_values(series.min, res.count);
+            var maximum = decode_values(series.max, res.count);
+            var low = [];
+            var high = [];
+            var with_date = res.count * res.step > 86400 * 1000;
+            for (var i = 0; i < res.count; i++) {
+                if (minimum[i] === null) { continue; }
+                labels.push(format_label(res.start + i * res.step, with_date));
+                low.push(minimum[i]);
+                high.push(maximum[i]);
+            }
+            values = low.concat(high);
+            datasets.push({strokeColor: colours[0], data: high, title: type + " max"});
+            datasets.push({strokeColor: colours[2], data: low, title: type + " min"});
+        }
+        if (labels.length == 0) { return }
+        var options = {
+            graphTitle: series.title,
+            graphTitleFontSize: 16,
+            canvasBorders: true,
+            canvasBordersWidth: 1,
+            animation : false,
+            responsive: true,
+            datasetFill: false,
+            pointDot: false,
+            annotateLabel: "<%=v2+': '+v1+' '+v3%>",
+            annotateDisplay: true,
+            yAxisMinimumInterval: calculate_yaxis(values),
+            showXLabels: false,
+            yAxisUnit: series.unit,
+            yAxisUnitFontSize: 16,
+            forceScale:"steps",
+            scaleSteps : 10,
+            fmtYLabel: "number",
+        };
+        new Chart(canvas.getContext("2d")).Line({labels: labels, datasets: datasets}, options);
+    });
+    return false;
+}
+
+function load_graph(canvas_id, type)
+{
+    var x= get_period();
+    var period = x[0];
+    var interval = x[1];
+    if (period == 'custom') {
+        // Averages over a 25th of an arbitrary range hide spikes
+        return load_downsampled_graph(canvas_id, type, period, interval, 'envelope');
+    }
+    load_series([type], period, interval, function(series) {
+        var res = series.series[type];
+        res.labels = series.labels;
         var interval_size = calculate_yaxis(res.data);
 //        console.log(interval_size);
         var options= {
@@ -187,7 +317,7 @@ function load_graph(canvas_id, type)
 }
 
 var simple_types = ["temperature", 'humidity', 'pressure', 'oxidising', 'reducing', 'nh3', "lux" , "proximity"
-                , "pm1" , "pm25", "pm10", "noise_low", "noise_mid", "noise_high"];
+                , "pm1" , "pm25", "pm10", "noise_low", "noise_mid", "noise_high", "noise_leq", "noise_peak"];
 
 var composite_types = ["noise", "particles"];
 var all_types = simple_types.concat(composite_types);
@@ -259,19 +389,51 @@ function load_currents()
         cache: false,
         contentType: "application/json;charset=UTF-8",
     }).done(function(data) {
-        var res = JSON.parse(data);
-        var temp_desc = res['description']['temperature']
-        var hum_desc = res['description']['humidity']
-        var press_desc = res['description']['pressure']
+        show_currents(JSON.parse(data));
+    });
+}
+
+var currents_timer = null;
+
+function poll_currents()
+{
+    load_currents();
+    if (currents_timer === null) {
+        currents_timer = setInterval(load_currents, 5000);
+    }
+}
+
+function watch_currents()
+{
+    // New readings are pushed by the server; fall back to polling if the browser or the connection can't do that
+    if (!window.EventSource) {
+        poll_currents();
+        return;
+    }
+    var source = new EventSource(script_root + '/stream/latest');
+    source.onmessage = function(event) {
+        show_currents(JSON.parse(event.data));
+    };
+    source.onerror = function() {
+        if (source.readyState == EventSource.CLOSED) {
+            poll_currents();
+        }
+    };
+}
+
+function show_currents(res)
+{
+    var temp_desc = res['description']['temperature']
+    var hum_desc = res['description']['humidity']
+    var press_desc = res['description']['pressure']
 //        console.log(img_path, hum_desc, temp_desc, res)
-        $("#current_temperature").text(round(res['data']['temperature'],1) + res['units']['temperature']);
-        $("#current_humidity").text(round(res['data']['humidity'],1) + res['units']['humidity']);
-        $("#current_pressure").text(round(res['data']['pressure'],0) + ' ' +res['units']['pressure']);
+    $("#current_temperature").text(round(res['data']['temperature'],1) + res['units']['temperature']);
+    $("#current_humidity").text(round(res['data']['humidity'],1) + res['units']['humidity']);
+    $("#current_pressure").text(round(res['data']['pressure'],0) + ' ' +res['units']['pressure']);
 //       console.log(img_path + "/humidity_" + hum_desc + '.png')
-        $("#humidity_icon").attr("src", img_path + "/humidity-" + hum_desc + '.png')
-        $("#temperature_icon").attr("src", img_path + "/temperature-" + temp_desc + '.png')
-        $("#pressure_icon").attr("src", img_path + "/pressure-" + press_desc + '.png')
-    });
+    $("#humidity_icon").attr("src", img_path + "/humidity-" + hum_desc + '.png')
+    $("#temperature_icon").attr("src", img_path + "/temperature-" + temp_desc + '.png')
+    $("#pressure_icon").attr("src", img_path + "/pressure-" + press_desc + '.png')
 }
 
 function load_sun_times()
@@ -296,6 +458,7 @@ var avg = 0;
 var mx = 0;
 var mn = 0;
 var std = 0
+var percentiles = '';
 var chg = '';
 var trend = null;
 var period = get_period()[0]
@@ -315,10 +478,14 @@ var period = get_period()[0]
         mn = round(res.data.min, 2);
         mx = round(res.data.max, 2);
         std = round(res.data.std, 2);
+        if (res.data.p50 !== null) {
+            percentiles = "<br>P50: " + round(res.data.p50, 2) + "<br>P95: " + round(res.data.p95, 2) +
+                "<br>P99: " + round(res.data.p99, 2);
+        }
         chg = round(res.data.change_per_hour, 2);
         trend = res.data.trend;
     });
-        return "Avg: " + avg + "<br>Min: " + mn + "<br>Max: " + mx + "<br>Std Dev: " + std  + "<br><br>Change: " + chg + " " + trend;
+        return "Avg: " + avg + "<br>Min: " + mn + "<br>Max: " + mx + "<br>Std Dev: " + std + percentiles + "<br><br>Change: " + chg + " " + trend;
 }
 
 function calculate_height()
@@ -354,7 +521,7 @@ $( document ).ready(function() {
         load_all_graphs();
     });
     load_all_graphs();
-    load_currents();
+    watch_currents();
 
     $('[name="selected"').change(function(event) {
         update_session();
@@ -373,7 +540,6 @@ $( document ).ready(function() {
     });
 
     load_sun_times();
-    setInterval(load_currents, 5000);
     setInterval(load_sun_times, 1000 * 60 * 60);
     calculate_height();
 });
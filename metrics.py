@@ -0,0 +1,66 @@
+import logging
+
+try:
+    from prometheus_client import Counter, Gauge, Histogram, start_http_server
+except ImportError:
+    start_http_server = None
+
+
+class NullMetric:
+    """Stands in for the metrics while the exporter isn't running, so instrumenting costs next to nothing"""
+
+    def labels(self, *args, **kwargs):
+        return self
+
+    def observe(self, value):
+        pass
+
+    def inc(self, amount=1):
+        pass
+
+    def set(self, value):
+        pass
+
+    def set_function(self, f):
+        pass
+
+
+READING = NullMetric()
+SENSOR_READ_SECONDS = NullMetric()
+SENSOR_FAULTS = NullMetric()
+I2C_RESETS = NullMetric()
+JOB_LATENESS_SECONDS = NullMetric()
+JOB_SKIPPED_RUNS = NullMetric()
+STORAGE_INSERT_SECONDS = NullMetric()
+STORAGE_SPOOLED_READINGS = NullMetric()
+WRITE_QUEUE_DEPTH = NullMetric()
+DISPLAY_RENDER_SECONDS = NullMetric()
+
+_fast_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def start_exporter(port, addr='0.0.0.0'):
+    """Register the metrics and serve them in Prometheus format from a background thread. All values are kept in
+       memory, so a scrape never touches Mongo or the sensors."""
+    global READING, SENSOR_READ_SECONDS, SENSOR_FAULTS, I2C_RESETS, JOB_LATENESS_SECONDS, JOB_SKIPPED_RUNS, \
+        STORAGE_INSERT_SECONDS, STORAGE_SPOOLED_READINGS, WRITE_QUEUE_DEPTH, DISPLAY_RENDER_SECONDS
+    if start_http_server is None:
+        logging.error("prometheus_client is not installed; not exposing metrics")
+        return False
+    READING = Gauge('enviro_reading', 'Current averaged reading', ['sensor'])
+    SENSOR_READ_SECONDS = Histogram('enviro_sensor_read_seconds', 'Time taken to read a sensor', ['sensor'],
+                                    buckets=_fast_buckets)
+    SENSOR_FAULTS = Counter('enviro_sensor_faults', 'Failed sensor reads', ['sensor'])
+    I2C_RESETS = Counter('enviro_i2c_resets', 'Resets of the i2c bus')
+    JOB_LATENESS_SECONDS = Histogram('enviro_job_lateness_seconds', 'How late a scheduled job started', ['job'],
+                                     buckets=_fast_buckets)
+    JOB_SKIPPED_RUNS = Counter('enviro_job_skipped_runs', 'Runs skipped because a job overran its slot', ['job'])
+    STORAGE_INSERT_SECONDS = Histogram('enviro_storage_insert_seconds', 'Time taken to write a batch to the storage',
+                                       buckets=_fast_buckets)
+    STORAGE_SPOOLED_READINGS = Counter('enviro_storage_spooled_readings', 'Readings spooled to disk')
+    WRITE_QUEUE_DEPTH = Gauge('enviro_write_queue_depth', 'Readings waiting to be written to the storage')
+    DISPLAY_RENDER_SECONDS = Histogram('enviro_display_render_seconds', 'Time taken to render a display frame',
+                                       buckets=_fast_buckets)
+    start_http_server(port, addr=addr)
+    logging.info("Exposing metrics on {}:{}".format(addr, port))
+    return True
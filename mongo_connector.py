@@ -1,4 +1,63 @@
-from pymongo import MongoClient
+import contextlib
+import logging
+import threading
+import time
+
+from pymongo import ASCENDING, MongoClient
+from pymongo.errors import ExecutionTimeout, OperationFailure, PyMongoError
+
+# Connection pool settings and the config keys that override them
+_pool_options = {
+    'maxPoolSize': ('max_pool_size', 20),
+    'minPoolSize': ('min_pool_size', 2),
+    'waitQueueTimeoutMS': ('wait_queue_timeout_ms', 5000),
+}
+_deadline = threading.local()
+
+
+class QueryPlanError(Exception):
+    pass
+
+
+def plan_stages(explanation):
+    """All stage names in the winning plans of an explain() result"""
+    stages = []
+    if isinstance(explanation, dict):
+        for key, value in explanation.items():
+            if key == 'rejectedPlans':
+                continue
+            if key == 'stage' and isinstance(value, str):
+                stages.append(value)
+            else:
+                stages += plan_stages(value)
+    elif isinstance(explanation, list):
+        for value in explanation:
+            stages += plan_stages(value)
+    return stages
+
+
+@contextlib.contextmanager
+def query_deadline(seconds):
+    """Queries that this thread issues in the block and that take deadline_options() get seconds in all; Mongo
+       aborts them when the time is up, so a query nobody waits for any more doesn't keep running"""
+    previous = getattr(_deadline, 'at', None)
+    _deadline.at = time.monotonic() + seconds
+    try:
+        yield
+    finally:
+        _deadline.at = previous
+
+
+def deadline_options(aggregate=False):
+    """The keyword argument that limits the time of a find() (or with aggregate, of an aggregate()) to what is left
+       of the query_deadline() it runs under; none outside query_deadline()"""
+    at = getattr(_deadline, 'at', None)
+    if at is None:
+        return {}
+    left = int((at - time.monotonic()) * 1000)
+    if left <= 0:
+        raise ExecutionTimeout("Deadline exceeded", 50)
+    return {'maxTimeMS' if aggregate else 'max_time_ms': left}
 
 
 class MongoConnector:
@@ -6,12 +65,13 @@ class MongoConnector:
         self._config = config
         hostname = self._config['hostname'] if self._config['hostname'] != "" else None
         port = self._config['port'] if self._config['port'] != "" else None
+        pool = {option: self._config.get(key, default) for option, (key, default) in _pool_options.items()}
         if 'username' in self._config and 'password' in self._config and \
                 (self._config['username'] != '' and self._config['password'] != ''):
             self._mongo = MongoClient(username=self._config['username'], password=self._config['password'],
-                                      authSource=self._config['auth_db'], host=hostname, port=port)
+                                      authSource=self._config['auth_db'], host=hostname, port=port, **pool)
         else:
-            self._mongo = MongoClient(host=hostname, port=port)
+            self._mongo = MongoClient(host=hostname, port=port, **pool)
         self._db = self._mongo[self._config['database']]
         self._collection = self._db[self._config['collection']]
         self._hourly_collection = self._db[self._config['aggregate_collection']]
@@ -23,4 +83,52 @@ class MongoConnector:
         return self._collection
 
     def get_db(self):
-        return self._db
\ No newline at end of file
+        return self._db
+
+    def ensure_indexes(self):
+        """Create the indexes the queries need; a no-op if they exist. Returns False if Mongo can't be reached."""
+        try:
+            self._collection.create_index([("timestamp", ASCENDING)], name="timestamp")
+            try:
+                self._hourly_collection.create_index([("timestamp", ASCENDING)], name="timestamp", unique=True)
+            except OperationFailure as e:
+                # Rows written by older versions of the summariser can share an hour
+                logging.error("Can't create a unique index on the hourly timestamps: {}".format(e))
+                self._hourly_collection.create_index([("timestamp", ASCENDING)], name="timestamp_nonunique")
+        except PyMongoError as e:
+            logging.error("Can't create the indexes: {}".format(e))
+            return False
+        return True
+
+    def explain(self, collection, kind, spec):
+        """The explain() output of a query shape: kind is 'find' (spec has filter, projection, sort and limit),
+           'aggregate' (spec is the pipeline), 'update' or 'delete' (spec has the filter)"""
+        if kind == 'find':
+            cursor = collection.find(spec.get('filter', {}), spec.get('projection'))
+            if spec.get('sort'):
+                cursor = cursor.sort(spec['sort'])
+            if spec.get('limit'):
+                cursor = cursor.limit(spec['limit'])
+            return cursor.explain()
+        if kind == 'aggregate':
+            command = {'aggregate': collection.name, 'pipeline': spec, 'cursor': {}}
+        elif kind == 'update':
+            command = {'update': collection.name, 'updates': [{'q': spec['filter'], 'u': spec['update'],
+                                                               'upsert': spec.get('upsert', False)}]}
+        elif kind == 'delete':
+            command = {'delete': collection.name, 'deletes': [{'q': spec['filter'], 'limit': 0}]}
+        else:
+            raise ValueError("Unknown query kind {}".format(kind))
+        return self._db.command('explain', command, verbosity='queryPlanner')
+
+    def audit(self, shapes):
+        """Explain every (name, collection, kind, spec) query shape; raises QueryPlanError listing the shapes that
+           scan a whole collection"""
+        failed = []
+        for name, collection, kind, spec in shapes:
+            stages = plan_stages(self.explain(collection, kind, spec))
+            logging.info("Query {} on {}: {}".format(name, collection.name, " > ".join(reversed(stages))))
+            if 'COLLSCAN' in stages:
+                failed.append(name)
+        if failed:
+            raise QueryPlanError("Collection scans in: {}".format(", ".join(failed)))
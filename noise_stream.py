@@ -0,0 +1,149 @@
+import logging
+import math
+import threading
+
+import numpy
+
+
+def dbfs(amplitude):
+    """Level of an amplitude relative to digital full scale in dB; None for silence"""
+    return 20 * math.log10(amplitude) if amplitude > 0 else None
+
+
+class NoiseStream:
+    """Keeps the microphone open and analyses the audio continuously. The capture callback only copies the samples
+       into a ring buffer and keeps the sum of squares and peak for the current interval; an analysis thread runs
+       one vectorised FFT over all the overlapping windows that came in since it last ran and keeps the band levels.
+       Reading the levels is O(1) and leaves no gaps between samples.
+
+       The band levels are calculated like enviroplus.noise.Noise.get_noise_profile (mean FFT magnitude per band of
+       1 Hz bins above the noise floor), so they stay comparable with the readings stored before."""
+
+    def __init__(self, sample_rate=16000, window=0.5, overlap=0.5, buffer_seconds=4, noise_floor=100, low=0.12,
+                 mid=0.36, high=None):
+        if high is None:
+            high = 1.0 - low - mid
+        self._sample_rate = sample_rate
+        self._window_size = int(window * sample_rate)
+        self._hop = max(1, int(self._window_size * (1 - overlap)))
+        self._buffer = numpy.zeros(int(buffer_seconds * sample_rate))
+        self._offsets = numpy.arange(self._window_size)
+        bin_count = (sample_rate // 2) - noise_floor
+        self._bands = [noise_floor, noise_floor + int(bin_count * low)]
+        self._bands.append(self._bands[-1] + int(bin_count * mid))
+        self._bands.append(self._bands[-1] + int(bin_count * high))
+        self._lock = threading.Lock()
+        self._data_ready = threading.Event()
+        self._stop_event = threading.Event()
+        self._stream = None
+        self._thread = None
+        # Total number of samples written, and the start of the next window to analyse
+        self._written = 0
+        self._next_window = 0
+        self._levels = None
+        self._reset_interval()
+
+    def _reset_interval(self):
+        self._band_sums = numpy.zeros(4)
+        self._windows = 0
+        self._square_sum = 0.0
+        self._samples = 0
+        self._peak = 0.0
+
+    def start(self):
+        import sounddevice
+
+        self._stop_event.clear()
+        stream = sounddevice.InputStream(samplerate=self._sample_rate, channels=1, dtype='float64',
+                                         callback=self._capture)
+        try:
+            stream.start()
+        except Exception:
+            stream.close()
+            raise
+        self._stream = stream
+        self._thread = threading.Thread(target=self._analyse, name="noise-analysis", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._data_ready.set()
+        if self._stream is not None:
+            self._stream.stop()
+            self._stream.close()
+            self._stream = None
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def restart(self):
+        """Reopen the audio device"""
+        self.stop()
+        self.start()
+
+    def _capture(self, indata, frames, time_info, status):
+        if status:
+            logging.debug("Audio capture status: {}".format(status))
+        samples = indata[:, 0]
+        size = len(self._buffer)
+        with self._lock:
+            pos = self._written % size
+            first = min(frames, size - pos)
+            self._buffer[pos:pos + first] = samples[:first]
+            self._buffer[:frames - first] = samples[first:]
+            self._written += frames
+            self._square_sum += float(numpy.dot(samples, samples))
+            self._samples += frames
+            self._peak = max(self._peak, float(numpy.abs(samples).max(initial=0.0)))
+        self._data_ready.set()
+
+    def _analyse(self):
+        size = len(self._buffer)
+        while not self._stop_event.is_set():
+            self._data_ready.wait(1)
+            self._data_ready.clear()
+            with self._lock:
+                written = self._written
+                if written - self._next_window > size - self._hop:
+                    # Fell behind by more than the buffer holds; carry on from the newest complete window
+                    self._next_window = written - self._window_size
+                count = (written - self._next_window - self._window_size) // self._hop + 1
+                if count <= 0:
+                    continue
+                starts = self._next_window + numpy.arange(count) * self._hop
+                frames = self._buffer[(starts[:, None] + self._offsets) % size]
+                self._next_window += count * self._hop
+            magnitude = numpy.abs(numpy.fft.rfft(frames, n=self._sample_rate, axis=1))
+            levels = numpy.empty((count, 4))
+            for i in range(3):
+                levels[:, i] = magnitude[:, self._bands[i]:self._bands[i + 1]].mean(axis=1)
+            levels[:, 3] = levels[:, :3].mean(axis=1)
+            with self._lock:
+                self._levels = tuple(levels[-1].tolist())
+                self._band_sums += levels.sum(axis=0)
+                self._windows += count
+
+    def get_noise_profile(self):
+        """The low, mid and high band levels and their mean of the most recent window; None before the first one"""
+        with self._lock:
+            return self._levels
+
+    def get_interval(self):
+        """Band levels averaged over all windows since the previous call, plus the mean square (the energy behind the
+           equivalent continuous level, Leq) and the peak amplitude of all samples since then. None if no full window
+           came in."""
+        with self._lock:
+            if self._windows == 0:
+                return None
+            low, mid, high, amp = (self._band_sums / self._windows).tolist()
+            mean_square = self._square_sum / self._samples if self._samples else 0.0
+            peak = self._peak
+            self._reset_interval()
+        return {
+            'low': low,
+            'mid': mid,
+            'high': high,
+            'amp': amp,
+            'mean_square': mean_square,
+            'peak': peak,
+        }
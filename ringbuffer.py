@@ -0,0 +1,142 @@
+import collections
+import math
+
+import numpy
+
+
+class RingBuffer:
+    """Preallocated ring buffer with one column per measurement and running statistics (sum, mean, variance, min,
+       max and an EWMA) that are updated in O(1) per sample. Each column keeps its own write position, as the sensors
+       deliver their readings at different rates; the timestamps are kept alongside the values."""
+
+    def __init__(self, columns, size=3, alpha=0.3):
+        if size < 1:
+            raise ValueError("Invalid size {}".format(size))
+        self._columns = list(columns)
+        self._index = {name: i for i, name in enumerate(self._columns)}
+        ncol = len(self._columns)
+        self._size = size
+        self._alpha = alpha
+        self._data = numpy.zeros((size, ncol))
+        self._times = numpy.zeros((size, ncol))
+        self._head = [0] * ncol
+        self._seq = [0] * ncol
+        self._count = numpy.zeros(ncol, dtype=numpy.int64)
+        self._mean = numpy.zeros(ncol)
+        self._m2 = numpy.zeros(ncol)
+        self._min = numpy.zeros(ncol)
+        self._max = numpy.zeros(ncol)
+        self._ewma = numpy.zeros(ncol)
+        self._last_time = numpy.full(ncol, numpy.nan)
+        # Monotonic queues of (sequence number, value) giving the window minimum and maximum in amortised O(1)
+        self._min_queue = [collections.deque() for _ in range(ncol)]
+        self._max_queue = [collections.deque() for _ in range(ncol)]
+
+    @property
+    def columns(self):
+        return list(self._columns)
+
+    def add(self, values, timestamp):
+        """Add a reading for each of the columns in values (a dict of column name to value)"""
+        for name, value in values.items():
+            c = self._index[name]
+            value = float(value)
+            pos = self._head[c]
+            seq = self._seq[c]
+            count = self._count[c]
+            mean = self._mean[c]
+            if count == self._size:
+                # Full window: replace the oldest value (Welford update for a sliding window)
+                old = self._data[pos, c]
+                new_mean = mean + (value - old) / count
+                self._m2[c] += (value - old) * (value - new_mean + old - mean)
+                self._mean[c] = new_mean
+                self._ewma[c] += self._alpha * (value - self._ewma[c])
+            else:
+                count += 1
+                self._count[c] = count
+                delta = value - mean
+                self._mean[c] = mean + delta / count
+                self._m2[c] += delta * (value - self._mean[c])
+                self._ewma[c] = value if count == 1 else self._ewma[c] + self._alpha * (value - self._ewma[c])
+            self._data[pos, c] = value
+            self._times[pos, c] = timestamp
+            self._last_time[c] = timestamp
+            pos = (pos + 1) % self._size
+            self._head[c] = pos
+            self._seq[c] = seq + 1
+
+            oldest = seq - count + 1
+            min_queue = self._min_queue[c]
+            while min_queue and min_queue[-1][1] >= value:
+                min_queue.pop()
+            min_queue.append((seq, value))
+            while min_queue[0][0] < oldest:
+                min_queue.popleft()
+            self._min[c] = min_queue[0][1]
+            max_queue = self._max_queue[c]
+            while max_queue and max_queue[-1][1] <= value:
+                max_queue.pop()
+            max_queue.append((seq, value))
+            while max_queue[0][0] < oldest:
+                max_queue.popleft()
+            self._max[c] = max_queue[0][1]
+
+            if pos == 0 and count == self._size:
+                # Once per lap recompute the mean and variance from scratch, so rounding errors can't accumulate
+                column = self._data[:, c]
+                self._mean[c] = column.mean()
+                self._m2[c] = ((column - self._mean[c]) ** 2).sum()
+
+    def snapshot(self):
+        """A copy of the running statistics of all columns at once, as arrays in column order"""
+        count = self._count.copy()
+        empty = count == 0
+        return {
+            'count': count,
+            'sum': self._mean * count,
+            'mean': numpy.where(empty, 0.0, self._mean),
+            'variance': numpy.where(empty, 0.0, numpy.maximum(self._m2, 0.0) / numpy.maximum(count, 1)),
+            'min': numpy.where(empty, 0.0, self._min),
+            'max': numpy.where(empty, 0.0, self._max),
+            'ewma': numpy.where(empty, 0.0, self._ewma),
+            'last_time': self._last_time.copy(),
+        }
+
+    def averages(self):
+        """The window average per column; 0 for columns without any readings"""
+        return dict(zip(self._columns, self.snapshot()['mean'].tolist()))
+
+    def window(self, name):
+        """The values of a column currently in the window, oldest first"""
+        c = self._index[name]
+        count = self._count[c]
+        column = numpy.roll(self._data[:, c], -self._head[c])
+        return column[self._size - count:]
+
+    def __len__(self):
+        return self._size
+
+    def __str__(self):
+        return str({name: self.window(name).tolist() for name in self._columns})
+
+
+if __name__ == '__main__':
+    # Check the window size is honoured exactly and the running statistics match a full recomputation
+    rng = numpy.random.default_rng(1)
+    for size in (1, 2, 5, 13):
+        a = RingBuffer(['x', 'y'], size)
+        xs = []
+        for i in range(200):
+            x = float(rng.normal(1000, 5))
+            xs.append(x)
+            a.add({'x': x}, i)
+            expected = numpy.array(xs[-size:])
+            stats = a.snapshot()
+            assert stats['count'][0] == len(expected) == min(i + 1, size)
+            assert numpy.array_equal(a.window('x'), expected)
+            assert math.isclose(stats['mean'][0], expected.mean(), rel_tol=1e-12)
+            assert math.isclose(stats['variance'][0], expected.var(), rel_tol=1e-6, abs_tol=1e-9)
+            assert stats['min'][0] == expected.min() and stats['max'][0] == expected.max()
+            assert stats['count'][1] == 0 and len(a.window('y')) == 0
+    print("ok")
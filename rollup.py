@@ -0,0 +1,237 @@
+import abc
+import argparse
+import datetime
+import logging
+import math
+
+import pytz
+from pymongo import ReplaceOne, UpdateOne
+
+from sensor_types import types
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=pytz.UTC)
+MILLISECOND = datetime.timedelta(milliseconds=1)
+HOUR_MS = 3600 * 1000
+
+# Resolutions of the rollup tiers in seconds
+TIERS = (60, 900, 3600, 86400)
+_fields = ('n', 'sx', 'sy', 'sxy', 'sxx', 'syy')
+
+
+def to_millis(t):
+    """Milliseconds since the epoch of a datetime; naive datetimes (as returned by pymongo) are taken as UTC"""
+    if t.tzinfo is None:
+        t = t.replace(tzinfo=pytz.UTC)
+    return (t - EPOCH) // MILLISECOND
+
+
+def from_millis(ms):
+    return EPOCH + ms * MILLISECOND
+
+
+def is_number(value):
+    """Whether a reading holds a value: a number that isn't NaN"""
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and not math.isnan(value)
+
+
+def bucket_sums(docs, resolution, rtypes):
+    """Sums per bucket of resolution seconds and per type: {bucket start (ms): {type: [n, Σx, Σy, Σxy, Σx², Σy²,
+       min, max]}} with x in seconds from the start of the bucket"""
+    size = resolution * 1000
+    buckets = {}
+    for doc in docs:
+        t = to_millis(doc['timestamp'])
+        start = t - t % size
+        x = (t - start) / 1000
+        bucket = buckets.setdefault(start, {})
+        for rtype in rtypes:
+            y = doc.get(rtype)
+            if not is_number(y):
+                continue
+            sums = bucket.get(rtype)
+            if sums is None:
+                sums = bucket[rtype] = [0, 0.0, 0.0, 0.0, 0.0, 0.0, y, y]
+            sums[0] += 1
+            sums[1] += x
+            sums[2] += y
+            sums[3] += x * y
+            sums[4] += x * x
+            sums[5] += y * y
+            sums[6] = min(sums[6], y)
+            sums[7] = max(sums[7], y)
+    return buckets
+
+
+class Summary(abc.ABC):
+    """Summaries of the readings that the writer keeps up to date as readings are inserted (add()). They hold every
+       reading from the time in the state document ('since') on; older readings are added by backfill(). Subclasses
+       fold readings in with _apply() and replace whole buckets with _replace()."""
+    STATE_ID = None
+
+    def __init__(self, state):
+        self._state = state
+        self._started = False
+
+    def covered_from(self):
+        """Time (ms) from which every reading is included; None if nothing is yet"""
+        state = self._state.find_one({'_id': self.STATE_ID})
+        if state is None or state.get('since') is None:
+            return None
+        return to_millis(state['since'])
+
+    def _lower_since(self, ms):
+        self._state.update_one({'_id': self.STATE_ID}, {'$min': {'since': from_millis(ms)}}, upsert=True)
+
+    def _start(self, ms):
+        if not self._started:
+            # Readings from before the first batch are not included until they are backfilled
+            self._state.update_one({'_id': self.STATE_ID}, {'$setOnInsert': {'since': from_millis(ms)}}, upsert=True)
+            self._started = True
+
+    def add(self, docs):
+        """Fold newly inserted readings in"""
+        if not docs:
+            return
+        self._start(min(to_millis(doc['timestamp']) for doc in docs))
+        self._apply(docs)
+
+    @abc.abstractmethod
+    def _apply(self, docs):
+        """Fold readings into the buckets"""
+
+    @abc.abstractmethod
+    def _bucket_size(self):
+        """The size in ms of the largest bucket"""
+
+    @abc.abstractmethod
+    def _replace(self, docs):
+        """Replace the buckets of the readings by ones made from just those readings"""
+
+    def rebuild(self, collection, start, end):
+        """Recompute the buckets with readings from start up to end (ms) from the readings in collection, replacing
+           what they held; for when folding in a batch failed halfway"""
+        size = self._bucket_size()
+        start -= start % size
+        end = -(-end // size) * size
+        docs = list(collection.find({'timestamp': {'$gte': from_millis(start), '$lt': from_millis(end)}}))
+        self._start(start)
+        self._replace(docs)
+        return len(docs)
+
+    def backfill(self, collection, chunk=86400):
+        """Add the readings in collection from before covered_from(), a chunk of seconds at a time going back, so an
+           interrupted backfill can be continued"""
+        first = collection.find_one({}, sort=[('timestamp', 1)])
+        if first is None:
+            return 0
+        lo = to_millis(first['timestamp'])
+        end = self.covered_from()
+        if end is None:
+            end = to_millis(datetime.datetime.now(pytz.UTC))
+            self._lower_since(end)
+        size = chunk * 1000
+        count = 0
+        while end > lo:
+            start = max((end - 1) // size * size, lo)
+            docs = list(collection.find({'timestamp': {'$gte': from_millis(start), '$lt': from_millis(end)}}))
+            self._apply(docs)
+            self._lower_since(start)
+            count += len(docs)
+            logging.info("Backfilled {} readings from {}".format(len(docs), from_millis(start)))
+            end = start
+        return count
+
+
+class Rollups(Summary):
+    """Rollup collections at the resolutions in tiers. Per bucket, every type has the count, sums, sums of squares
+       and cross products (x in seconds from the start of the bucket), minimum and maximum of its readings, so
+       averages, standard deviations and least squares trends can be put together from buckets exactly."""
+    STATE_ID = 'rollups'
+
+    def __init__(self, db, prefix='rollup_', tiers=TIERS, rtypes=None):
+        self.tiers = sorted(tiers)
+        super().__init__(db['{}state'.format(prefix)])
+        self._collections = {resolution: db['{}{}'.format(prefix, resolution)] for resolution in self.tiers}
+        self._types = rtypes if rtypes is not None else types
+
+    def collection(self, resolution):
+        return self._collections[resolution]
+
+    def generation(self):
+        """Counter that is raised whenever readings are added to buckets that could already have been cached"""
+        state = self._state.find_one({'_id': self.STATE_ID}, {'generation': 1})
+        return state.get('generation', 0) if state is not None else 0
+
+    def invalidate(self):
+        self._state.update_one({'_id': self.STATE_ID}, {'$inc': {'generation': 1}}, upsert=True)
+
+    def _bucket_size(self):
+        return self.tiers[-1] * 1000
+
+    def _replace(self, docs):
+        for resolution in self.tiers:
+            updates = []
+            for start, bucket in bucket_sums(docs, resolution, self._types).items():
+                doc = {'timestamp': from_millis(start)}
+                for rtype, sums in bucket.items():
+                    doc[rtype] = dict(zip(_fields + ('min', 'max'), sums))
+                updates.append(ReplaceOne({'_id': from_millis(start)}, doc, upsert=True))
+            if updates:
+                self._collections[resolution].bulk_write(updates, ordered=False)
+        self.invalidate()
+
+    def _apply(self, docs):
+        for resolution in self.tiers:
+            updates = []
+            for start, bucket in bucket_sums(docs, resolution, self._types).items():
+                if not bucket:
+                    continue
+                inc = {}
+                minimum = {}
+                maximum = {}
+                for rtype, sums in bucket.items():
+                    for name, value in zip(_fields, sums):
+                        inc['{}.{}'.format(rtype, name)] = value
+                    minimum['{}.min'.format(rtype)] = sums[6]
+                    maximum['{}.max'.format(rtype)] = sums[7]
+                update = {'$inc': inc, '$min': minimum, '$max': maximum,
+                          '$setOnInsert': {'timestamp': from_millis(start)}}
+                updates.append(UpdateOne({'_id': from_millis(start)}, update, upsert=True))
+            if updates:
+                self._collections[resolution].bulk_write(updates, ordered=False)
+
+    def resolution_for(self, interval):
+        """The coarsest tier to draw a chart with points interval seconds apart from: one that divides the interval,
+           or is at most a tenth of it, so a bucket straddling two points skews them little. None if raw readings
+           are needed."""
+        for resolution in reversed(self.tiers):
+            if resolution <= interval and (interval % resolution == 0 or resolution * 10 <= interval):
+                return resolution
+        return None
+
+    def backfill(self, collection, chunk=86400):
+        count = super().backfill(collection, chunk)
+        self.invalidate()
+        return count
+
+    def drop(self):
+        for collection in self._collections.values():
+            collection.drop()
+        self._state.delete_one({'_id': self.STATE_ID})
+
+
+if __name__ == '__main__':
+    from config import config
+    from mongo_connector import MongoConnector
+
+    parser = argparse.ArgumentParser(description="Fill the rollup tiers from the readings stored before they existed")
+    parser.add_argument("--rebuild", action='store_true',
+                        help="Drop the tiers and rebuild them from all readings; stop the collector first")
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s.%(msecs)03d %(levelname)-8s %(message)s', level=logging.INFO,
+                        datefmt='%Y-%m-%d %H:%M:%S')
+    mongo = MongoConnector(config)
+    rollups = Rollups(mongo.get_db(), config.get('rollup_prefix', 'rollup_'))
+    if args.rebuild:
+        rollups.drop()
+    logging.info("Backfilled {} readings in total".format(rollups.backfill(mongo.get_collection())))
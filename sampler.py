@@ -0,0 +1,32 @@
+import logging
+import threading
+import time
+
+
+class SensorWorker(threading.Thread):
+    """Calls a sensor read function in its own thread at a fixed cadence, so a slow sensor only delays itself."""
+
+    def __init__(self, name, read_func, interval):
+        super().__init__(name="sensor-{}".format(name), daemon=True)
+        self.sensor = name
+        self._read_func = read_func
+        self._interval = interval
+        self._stop_event = threading.Event()
+
+    def run(self):
+        next_run = time.monotonic()
+        while not self._stop_event.is_set():
+            try:
+                self._read_func()
+            except Exception as e:
+                logging.error("Sensor worker {} failed: {}".format(self.sensor, e))
+            next_run += self._interval
+            delay = next_run - time.monotonic()
+            if delay < 0:
+                # The read overran its slot; skip the missed slots rather than bursting to catch up
+                next_run = time.monotonic()
+                delay = 0
+            self._stop_event.wait(delay)
+
+    def stop(self):
+        self._stop_event.set()
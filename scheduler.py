@@ -0,0 +1,124 @@
+import bisect
+import logging
+import threading
+import time
+
+import metrics
+
+
+class LatenessHistogram:
+    """Histogram of how late (in seconds) a job started compared to its deadline"""
+    bounds = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30)
+
+    def __init__(self, bounds=None):
+        if bounds is not None:
+            self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def __str__(self):
+        labels = ["<={}s".format(x) for x in self.bounds] + [">{}s".format(self.bounds[-1])]
+        return " ".join("{}:{}".format(label, count) for label, count in zip(labels, self.counts) if count)
+
+
+class Job:
+    """A named job that runs every period seconds. If it falls behind, catch_up makes up every missed run back to
+       back; otherwise the missed runs are skipped and the job carries on at its next slot."""
+
+    def __init__(self, name, period, func, catch_up=False):
+        self.name = name
+        self.period = period
+        self.func = func
+        self.catch_up = catch_up
+        self.next_run = 0
+        self.runs = 0
+        self.skipped = 0
+        self.failures = 0
+        self.run_time = 0.0
+        self.lateness = LatenessHistogram()
+
+
+class Scheduler:
+    """Runs periodic jobs on deadlines from the monotonic clock, so the intervals neither drift nor jump when the
+       wall clock is adjusted. Jobs run one at a time on the thread that calls run()."""
+
+    def __init__(self):
+        self._jobs = []
+        self._stop_event = threading.Event()
+
+    def add(self, name, period, func, catch_up=False, delay=0):
+        """Add a job; its first run is delay seconds from now"""
+        job = Job(name, period, func, catch_up)
+        job.next_run = time.monotonic() + delay
+        self._jobs.append(job)
+        return job
+
+    def run(self):
+        while not self._stop_event.is_set():
+            job = min(self._jobs, key=lambda x: x.next_run)
+            now = time.monotonic()
+            if job.next_run > now:
+                self._stop_event.wait(job.next_run - now)
+                continue
+            job.lateness.observe(now - job.next_run)
+            metrics.JOB_LATENESS_SECONDS.labels(job.name).observe(now - job.next_run)
+            try:
+                job.func()
+            except Exception as e:
+                job.failures += 1
+                logging.error("Job {} failed: {}".format(job.name, e))
+            end = time.monotonic()
+            job.runs += 1
+            job.run_time += end - now
+            job.next_run += job.period
+            if job.next_run <= end and not job.catch_up:
+                missed = int((end - job.next_run) // job.period) + 1
+                job.skipped += missed
+                metrics.JOB_SKIPPED_RUNS.labels(job.name).inc(missed)
+                job.next_run += missed * job.period
+
+    def stop(self):
+        self._stop_event.set()
+
+    def stats(self):
+        """Run counts, skipped runs and lateness per job"""
+        return {job.name: {
+            'runs': job.runs,
+            'skipped': job.skipped,
+            'failures': job.failures,
+            'run_time': job.run_time,
+            'lateness': job.lateness,
+        } for job in self._jobs}
+
+    def report(self):
+        for job in self._jobs:
+            lateness = job.lateness
+            average = lateness.sum / lateness.count if lateness.count else 0
+            logging.info("Job {}: {} runs, {} skipped, {} failed, lateness avg {:.4f}s max {:.4f}s [{}]".format(
+                job.name, job.runs, job.skipped, job.failures, average, lateness.max, lateness))
+
+
+class BackgroundJob:
+    """Job function that runs func on a thread of its own, so a long run doesn't hold up the other jobs. A run is
+       skipped if the previous one is still going."""
+
+    def __init__(self, name, func, *args):
+        self._name = name
+        self._func = func
+        self._args = args
+        self._thread = None
+
+    def __call__(self):
+        if self._thread is not None and self._thread.is_alive():
+            logging.warning("Previous {} run still going; skipping this one".format(self._name))
+            return
+        self._thread = threading.Thread(target=self._func, args=self._args, name=self._name, daemon=True)
+        self._thread.start()
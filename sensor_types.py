@@ -0,0 +1,3 @@
+# The readings stored per document; shared by the web app and the summariser
+types = ["temperature", 'humidity', 'pressure', 'oxidising', 'reducing', 'nh3', "lux", "proximity", "pm1", "pm25",
+         "pm10", 'noise_low', 'noise_mid', 'noise_high', 'noise_leq', 'noise_peak']
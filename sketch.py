@@ -0,0 +1,177 @@
+import argparse
+import logging
+import math
+
+from pymongo import ReplaceOne, UpdateOne
+
+from rollup import Summary, from_millis, is_number, to_millis
+from sensor_types import types
+
+# Relative accuracy of the quantiles
+ALPHA = 0.01
+# Readings closer to zero than this are counted as zero
+MIN_VALUE = 1e-9
+
+
+class QuantileSketch:
+    """DDSketch: counts of readings in logarithmic bins. Bin i of the positive values holds (γ^(i-1), γ^i] with
+       γ = (1 + α) / (1 - α); negative values have bins of their own and zero has one bin. A quantile is answered
+       with the middle of its bin, which is within α times the exact value (the reading at rank ⌊q(n - 1)⌋ of the
+       sorted readings), whatever the distribution. Bins are keyed 'p<i>', 'n<i>' and 'z', so two sketches merge by
+       adding the counts of their bins, which Mongo can do with $inc."""
+
+    def __init__(self, alpha=ALPHA, bins=None):
+        self.alpha = alpha
+        self._gamma = (1 + alpha) / (1 - alpha)
+        self._log_gamma = math.log(self._gamma)
+        self.bins = dict(bins) if bins is not None else {}
+
+    def key(self, value):
+        if abs(value) < MIN_VALUE:
+            return 'z'
+        return '{}{}'.format('p' if value > 0 else 'n', math.ceil(math.log(abs(value)) / self._log_gamma))
+
+    def add(self, value, count=1):
+        key = self.key(value)
+        self.bins[key] = self.bins.get(key, 0) + count
+
+    def merge(self, bins):
+        """Add the counts of the bins of another sketch"""
+        for key, count in bins.items():
+            self.bins[key] = self.bins.get(key, 0) + count
+        return self
+
+    def count(self):
+        return sum(self.bins.values())
+
+    @staticmethod
+    def _order(key):
+        # The most negative values first
+        if key == 'z':
+            return 0
+        index = int(key[1:])
+        return -(1 << 20) - index if key[0] == 'n' else (1 << 20) + index
+
+    def _value(self, key):
+        if key == 'z':
+            return 0.0
+        value = 2 * self._gamma ** int(key[1:]) / (self._gamma + 1)
+        return -value if key[0] == 'n' else value
+
+    def quantile(self, q):
+        """The q quantile (0 ≤ q ≤ 1); None for an empty sketch"""
+        rank = math.floor(q * (self.count() - 1))
+        seen = 0
+        for key in sorted(self.bins, key=self._order):
+            if self.bins[key] <= 0:
+                continue
+            seen += self.bins[key]
+            if seen > rank:
+                return self._value(key)
+        return None
+
+
+class Sketches(Summary):
+    """A quantile sketch per hour of every type, in one collection: per hour a document with the start of the hour
+       as _id and per type the counts of its bins. The writer keeps them up to date with $inc as readings are
+       inserted, so the sketches of any range of hours merge into one by adding up the counts. The state document is
+       kept in the same collection. Like the rollups they are kept when the readings are summarised."""
+    STATE_ID = 'state'
+
+    def __init__(self, db, collection='sketches', resolution=3600, alpha=ALPHA, rtypes=None):
+        self._collection = db[collection]
+        super().__init__(self._collection)
+        self.resolution = resolution
+        self.alpha = alpha
+        self._types = rtypes if rtypes is not None else types
+
+    def collection(self):
+        return self._collection
+
+    def _bins(self, docs):
+        """{start of the hour (ms): {type: {bin: count}}} of the readings"""
+        size = self.resolution * 1000
+        sketch = QuantileSketch(self.alpha)
+        hours = {}
+        for doc in docs:
+            t = to_millis(doc['timestamp'])
+            hour = hours.setdefault(t - t % size, {})
+            for rtype in self._types:
+                y = doc.get(rtype)
+                if not is_number(y):
+                    continue
+                bins = hour.setdefault(rtype, {})
+                key = sketch.key(y)
+                bins[key] = bins.get(key, 0) + 1
+        return hours
+
+    def _apply(self, docs):
+        updates = []
+        for start, hour in self._bins(docs).items():
+            inc = {'{}.{}'.format(rtype, key): count for rtype, bins in hour.items() for key, count in bins.items()}
+            if inc:
+                updates.append(UpdateOne({'_id': from_millis(start)}, {'$inc': inc}, upsert=True))
+        if updates:
+            self._collection.bulk_write(updates, ordered=False)
+
+    def _bucket_size(self):
+        return self.resolution * 1000
+
+    def _replace(self, docs):
+        updates = [ReplaceOne({'_id': from_millis(start)}, hour, upsert=True)
+                   for start, hour in self._bins(docs).items() if hour]
+        if updates:
+            self._collection.bulk_write(updates, ordered=False)
+
+    def query_spec(self, rtype, start, end):
+        """The find() of the sketches of the hours from start up to end (ms, whole hours)"""
+        return {'filter': {'_id': {'$gte': from_millis(start), '$lt': from_millis(end)}, rtype: {'$exists': True}},
+                'projection': {rtype: 1}}
+
+    def drop(self):
+        self._collection.drop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Fill the quantile sketches from the readings stored before they "
+                                                 "existed")
+    parser.add_argument("--rebuild", action='store_true',
+                        help="Drop the sketches and rebuild them from all readings; stop the collector first")
+    parser.add_argument("--check", action='store_true', help="Compare the sketches against exact percentiles")
+    args = parser.parse_args()
+    if args.check:
+        import random
+
+        rng = random.Random(1)
+        samples = {
+            'lognormal': [rng.lognormvariate(1, 1.5) for _ in range(20000)],
+            'spiky': [rng.expovariate(0.2) + (500 if rng.random() < 0.02 else 0) for _ in range(20000)],
+            'mixed sign': [rng.gauss(2, 10) for _ in range(20000)] + [0] * 100,
+        }
+        for name, ys in samples.items():
+            # Sketches of parts, merged, must answer like one sketch of everything
+            parts = [QuantileSketch() for _ in range(24)]
+            for i, y in enumerate(ys):
+                parts[i % 24].add(y)
+            merged = QuantileSketch()
+            for part in parts:
+                merged.merge(part.bins)
+            ys = sorted(ys)
+            for q in (0, 0.5, 0.95, 0.99, 1):
+                exact = ys[math.floor(q * (len(ys) - 1))]
+                estimate = merged.quantile(q)
+                assert abs(estimate - exact) <= ALPHA * abs(exact) + 1e-12, (name, q, exact, estimate)
+            print("{}: {} bins for {} readings".format(name, len(merged.bins), len(ys)))
+        assert QuantileSketch().quantile(0.5) is None
+        print("ok")
+    else:
+        from config import config
+        from mongo_connector import MongoConnector
+
+        logging.basicConfig(format='%(asctime)s.%(msecs)03d %(levelname)-8s %(message)s', level=logging.INFO,
+                            datefmt='%Y-%m-%d %H:%M:%S')
+        mongo = MongoConnector(config)
+        sketches = Sketches(mongo.get_db(), config.get('sketch_collection', 'sketches'))
+        if args.rebuild:
+            sketches.drop()
+        logging.info("Sketched {} readings in total".format(sketches.backfill(mongo.get_collection())))
@@ -0,0 +1,433 @@
+import abc
+import contextlib
+import logging
+import sqlite3
+import threading
+
+import numpy
+import pymongo.errors
+
+from rollup import HOUR_MS, from_millis, is_number, to_millis
+from sensor_types import types
+from sketch import QuantileSketch
+from summarise import Compactor, cutoff_time
+from trend import RangeSums, RegressionSums
+
+
+class StorageError(Exception):
+    """The storage can't be reached, or readings could not be stored"""
+
+
+class Storage(abc.ABC):
+    """Where the readings are kept. The collector stores them with insert() and summarises the old ones with
+       compact(); the web app reads them with the other methods. Times are UTC datetimes; series() keys its buckets
+       on ms since the epoch."""
+
+    @abc.abstractmethod
+    def insert(self, docs):
+        """Store readings; readings with an _id that is stored already are skipped. Returns the number stored and
+           raises StorageError if any of the others could not be stored."""
+
+    def invalidate(self):
+        """Readings were stored out of order (replayed from the spool), into time that may already be cached"""
+
+    @abc.abstractmethod
+    def compact(self, months_retained=2, max_chunks=4):
+        """Replace at most max_chunks chunks of the readings older than months_retained by hourly averages; returns
+           the number of hours summarised"""
+
+    @abc.abstractmethod
+    def series(self, rtypes, start_time, end_time, interval):
+        """Sums and counts per interval of every type, the intervals aligned to multiples of the interval since the
+           epoch: {interval start (ms): {'<type>_sum': ..., '<type>_n': ...}}"""
+
+    @abc.abstractmethod
+    def range_sums(self, rtype, ranges):
+        """ranges maps a name to a (start, end) pair, end inclusive; a RangeSums per name with x in seconds from the
+           start of its range"""
+
+    @abc.abstractmethod
+    def quantiles(self, rtype, start_time, end_time, qs=(0.5, 0.95, 0.99)):
+        """{q: the q quantile of rtype}, None without readings"""
+
+    @abc.abstractmethod
+    def points(self, rtype, start_time, end_time):
+        """The timestamps (ms) and values of rtype as two NumPy arrays sorted on time"""
+
+    @abc.abstractmethod
+    def latest(self):
+        """The newest reading"""
+
+    @abc.abstractmethod
+    def latest_rows(self, count):
+        """The newest count readings, oldest first, topped up with hourly averages"""
+
+    @abc.abstractmethod
+    def scan(self, fields, after=None, before=None, descending=False, limit=0):
+        """Iterator over the readings between after and before (both exclusive) in timestamp order, with only the
+           timestamp and the given fields; it has a close() to stop early"""
+
+
+class MongoStorage(Storage):
+    """The readings in Mongo. Stored readings also go into the rollup tiers and the quantile sketches, if given. The
+       reads are answered by a QueryPlanner, which only the web app has."""
+
+    def __init__(self, mongo, rollups=None, sketches=None, planner=None, compaction_collection='compaction'):
+        self._collection = mongo.get_collection()
+        self._rollups = rollups
+        self._sketches = sketches
+        self._planner = planner
+        self._compactor = Compactor(mongo, compaction_collection)
+        # The (start, end) in ms of readings that are stored but may be missing from the rollups or sketches
+        self._repair = None
+
+    def insert(self, docs):
+        inserted = docs
+        errors = []
+        try:
+            self._collection.insert_many(docs, ordered=False)
+        except pymongo.errors.BulkWriteError as e:
+            write_errors = e.details.get('writeErrors', [])
+            # Duplicates are stored already, and were rolled up when they were first inserted
+            errors = [x for x in write_errors if x.get('code') != 11000]
+            failed = set(x['index'] for x in write_errors)
+            inserted = [doc for i, doc in enumerate(docs) if i not in failed]
+        except pymongo.errors.PyMongoError as e:
+            raise StorageError(e)
+        if inserted:
+            self._summarise(inserted)
+        if errors:
+            # The batch is spooled and replayed; what did make it in is skipped as duplicates then
+            raise StorageError("Could not write {} readings: {}".format(len(errors), errors[0].get('errmsg')))
+        return len(inserted)
+
+    def _summarise(self, docs):
+        """Fold stored readings into the rollups and sketches. If that fails halfway their buckets are off, and a
+           replay won't help since the readings are duplicates then, so the range is rebuilt from the stored readings
+           with the next batch instead."""
+        times = [to_millis(doc['timestamp']) for doc in docs]
+        span = (min(times), max(times) + 1)
+        if self._repair is not None:
+            span = (min(span[0], self._repair[0]), max(span[1], self._repair[1]))
+        try:
+            for summary in (self._rollups, self._sketches):
+                if summary is None:
+                    continue
+                if self._repair is not None:
+                    summary.rebuild(self._collection, *span)
+                else:
+                    summary.add(docs)
+            if self._repair is not None:
+                logging.info("Rebuilt the rollups and sketches from {} to {}".format(from_millis(span[0]),
+                                                                                      from_millis(span[1])))
+        except pymongo.errors.PyMongoError as e:
+            logging.error("Could not update the rollups and sketches; rebuilding them from {} with the next batch: {}"
+                          .format(from_millis(span[0]), e))
+            self._repair = span
+            return
+        self._repair = None
+
+    def invalidate(self):
+        if self._rollups is not None:
+            try:
+                self._rollups.invalidate()
+            except pymongo.errors.PyMongoError as e:
+                logging.error("Could not invalidate the cached buckets: {}".format(e))
+
+    def compact(self, months_retained=2, max_chunks=4):
+        return self._compactor.run(months_retained, max_chunks)
+
+    def series(self, rtypes, start_time, end_time, interval):
+        return self._planner.series(rtypes, start_time, end_time, interval)
+
+    def range_sums(self, rtype, ranges):
+        return self._planner.range_sums(rtype, ranges)
+
+    def quantiles(self, rtype, start_time, end_time, qs=(0.5, 0.95, 0.99)):
+        return self._planner.quantiles(rtype, start_time, end_time, qs)
+
+    def points(self, rtype, start_time, end_time):
+        return self._planner.points(rtype, start_time, end_time)
+
+    def latest(self):
+        return self._planner.latest()
+
+    def latest_rows(self, count):
+        return self._planner.latest_rows(count)
+
+    def scan(self, fields, after=None, before=None, descending=False, limit=0):
+        return self._planner.scan(fields, after, before, descending, limit)
+
+
+class SQLiteStorage(Storage):
+    """The readings in a local SQLite file, for a unit without a Mongo server. With WAL the web app reads while the
+       collector writes. The readings are kept in a table indexed on time (ms since the epoch) and summarised into an
+       hourly table like in Mongo; there are no rollups, since a range is a scan of a local index. The quantile
+       sketches are kept per hour like in Mongo, in a table updated in the transaction that stores the readings. A
+       chunk is summarised and deleted in one transaction, so there is nothing to resume after a crash."""
+
+    def __init__(self, path, rtypes=None, chunk_hours=6):
+        self._path = path
+        self._types = list(rtypes) if rtypes is not None else types
+        self._chunk = chunk_hours * HOUR_MS
+        self._local = threading.local()
+
+    def _columns(self, rtypes=None):
+        return ", ".join('"{}"'.format(rtype) for rtype in (rtypes if rtypes is not None else self._types))
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self._path, timeout=10, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            columns = ", ".join('"{}" REAL'.format(rtype) for rtype in self._types)
+            connection.execute("CREATE TABLE IF NOT EXISTS readings (id TEXT PRIMARY KEY, ts INTEGER NOT NULL, {})"
+                               .format(columns))
+            connection.execute("CREATE INDEX IF NOT EXISTS readings_ts ON readings (ts)")
+            connection.execute("CREATE TABLE IF NOT EXISTS hourly (ts INTEGER PRIMARY KEY, count INTEGER, {})"
+                               .format(columns))
+            # Types added since the file was made
+            for table in ('readings', 'hourly'):
+                present = set(row[1] for row in connection.execute("PRAGMA table_info({})".format(table)))
+                for rtype in self._types:
+                    if rtype not in present:
+                        try:
+                            connection.execute('ALTER TABLE {} ADD COLUMN "{}" REAL'.format(table, rtype))
+                        except sqlite3.OperationalError as e:
+                            # Another process added it just now
+                            logging.debug("Could not add column {}: {}".format(rtype, e))
+            connection.execute("CREATE TABLE IF NOT EXISTS sketches (hour INTEGER, type TEXT, bin TEXT, count INTEGER, "
+                               "PRIMARY KEY (hour, type, bin)) WITHOUT ROWID")
+            connection.execute("CREATE TABLE IF NOT EXISTS state (name TEXT PRIMARY KEY, value INTEGER)")
+            self._local.connection = connection
+            if self._sketches_since() is None:
+                self._backfill_sketches()
+        return connection
+
+    def _sketches_since(self):
+        """Time (ms) from which the sketches hold every reading; None if they hold nothing yet"""
+        row = self._local.connection.execute("SELECT value FROM state WHERE name = 'sketches_since'").fetchone()
+        return row[0] if row is not None else None
+
+    def _sketch(self, connection, rows):
+        """Add (ts, value per type) rows to the sketches"""
+        sketch = QuantileSketch()
+        bins = {}
+        for row in rows:
+            hour = row[0] - row[0] % HOUR_MS
+            for rtype, y in zip(self._types, row[1:]):
+                if y is not None:
+                    key = (hour, rtype, sketch.key(y))
+                    bins[key] = bins.get(key, 0) + 1
+        connection.executemany("INSERT INTO sketches (hour, type, bin, count) VALUES (?, ?, ?, ?) ON CONFLICT "
+                               "(hour, type, bin) DO UPDATE SET count = count + excluded.count",
+                               [key + (count,) for key, count in bins.items()])
+
+    def _backfill_sketches(self):
+        """Sketch the readings stored before the sketches existed; the hours summarised by then are left out"""
+        with self._transaction() as connection:
+            first = connection.execute("SELECT MIN(ts) FROM readings").fetchone()[0]
+            if self._sketches_since() is not None or first is None:
+                return
+            self._sketch(connection, connection.execute("SELECT ts, {} FROM readings".format(self._columns())))
+            connection.execute("INSERT INTO state (name, value) VALUES ('sketches_since', ?)", (first,))
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def _query(self, sql, params=()):
+        try:
+            return self._connection().execute(sql, params)
+        except sqlite3.Error as e:
+            raise StorageError(e)
+
+    def _doc(self, row, fields):
+        doc = {'timestamp': from_millis(row[0])}
+        doc.update(zip(fields, row[1:]))
+        return doc
+
+    def insert(self, docs):
+        rows = [(str(doc['_id']) if doc.get('_id') is not None else None, to_millis(doc['timestamp'])) +
+                tuple(doc.get(rtype) if is_number(doc.get(rtype)) else None for rtype in self._types) for doc in docs]
+        if not rows:
+            return 0
+        sql = "INSERT OR IGNORE INTO readings (id, ts, {}) VALUES ({})".format(
+            self._columns(), ", ".join("?" * (len(self._types) + 2)))
+        try:
+            with self._transaction() as connection:
+                # Duplicates are in the sketches already
+                stored = [row[1:] for row in rows if connection.execute(sql, row).rowcount]
+                if stored:
+                    connection.execute("INSERT OR IGNORE INTO state (name, value) VALUES ('sketches_since', ?)",
+                                       (min(row[0] for row in stored),))
+                    self._sketch(connection, stored)
+            return len(stored)
+        except sqlite3.Error as e:
+            raise StorageError(e)
+
+    def compact(self, months_retained=2, max_chunks=4):
+        cutoff = to_millis(cutoff_time(months_retained)) // HOUR_MS * HOUR_MS
+        columns = self._columns()
+        averages = ", ".join('AVG("{}")'.format(rtype) for rtype in self._types)
+        # An hour that was summarised before gets the late readings averaged in
+        merge = ", ".join('"{0}" = CASE WHEN hourly."{0}" IS NULL THEN excluded."{0}" WHEN excluded."{0}" IS NULL '
+                          'THEN hourly."{0}" ELSE (hourly."{0}" * hourly.count + excluded."{0}" * excluded.count) / '
+                          '(hourly.count + excluded.count) END'.format(rtype) for rtype in self._types)
+        hours = 0
+        chunks = 0
+        try:
+            connection = self._connection()
+            while max_chunks is None or chunks < max_chunks:
+                first = connection.execute("SELECT MIN(ts) FROM readings").fetchone()[0]
+                if first is None:
+                    break
+                start = first // HOUR_MS * HOUR_MS
+                end = min(start + self._chunk, cutoff)
+                if end <= start:
+                    break
+                with self._transaction():
+                    count = connection.execute(
+                        "INSERT INTO hourly (ts, count, {}) SELECT ts - ts % ? AS hour, COUNT(*), {} FROM readings "
+                        "WHERE ts >= ? AND ts < ? GROUP BY hour ON CONFLICT (ts) DO UPDATE SET {}, "
+                        "count = hourly.count + excluded.count".format(columns, averages, merge),
+                        (HOUR_MS, start, end)).rowcount
+                    removed = connection.execute("DELETE FROM readings WHERE ts >= ? AND ts < ?",
+                                                 (start, end)).rowcount
+                logging.info("Summarised {} readings from {} into {} hours".format(removed, from_millis(start), count))
+                hours += count
+                chunks += 1
+        except sqlite3.Error as e:
+            logging.error("Summarising failed: {}".format(e))
+        return hours
+
+    def series(self, rtypes, start_time, end_time, interval):
+        size = 1000 * interval
+        start = to_millis(start_time) // size * size
+        end = to_millis(end_time)
+        sums = ", ".join('SUM("{0}"), COUNT("{0}")'.format(rtype) for rtype in rtypes)
+        weighted = ", ".join('SUM("{0}" * count), SUM(CASE WHEN "{0}" IS NULL THEN 0 ELSE count END)'.format(rtype)
+                             for rtype in rtypes)
+        buckets = {}
+        # Hours summarised count as their readings at the start of the hour
+        for table, columns in (('hourly', weighted), ('readings', sums)):
+            for row in self._query("SELECT ts - ts % ? AS bucket, {} FROM {} WHERE ts >= ? AND ts <= ? GROUP BY bucket"
+                                   .format(columns, table), (size, start, end)):
+                bucket = buckets.setdefault(row[0], {"{}_{}".format(rtype, key): 0 for rtype in rtypes
+                                                     for key in ('sum', 'n')})
+                for i, rtype in enumerate(rtypes):
+                    bucket["{}_sum".format(rtype)] += row[1 + 2 * i] or 0
+                    bucket["{}_n".format(rtype)] += row[2 + 2 * i]
+        return buckets
+
+    def range_sums(self, rtype, ranges):
+        results = {}
+        for name, (start_time, end_time) in ranges.items():
+            start = to_millis(start_time)
+            end = to_millis(end_time) + 1
+            result = results[name] = RangeSums()
+            n, sx, sy, sxy, sxx, syy, minimum, maximum = self._query(
+                'SELECT COUNT(y), SUM(x), SUM(y), SUM(x * y), SUM(x * x), SUM(y * y), MIN(y), MAX(y) FROM (SELECT '
+                '(ts - ?) / 1000.0 AS x, "{0}" AS y FROM readings WHERE ts >= ? AND ts < ? AND "{0}" IS NOT NULL)'
+                .format(rtype), (start, start, end)).fetchone()
+            if n:
+                result.merge(RangeSums(RegressionSums(n, sx, sy, sxy, sxx, syy), minimum, maximum))
+            # Summarised hours count as their readings in the middle of the part of the hour inside the range, all at
+            # the average; an hour partly inside only with that share of its readings, like in Mongo
+            for hour, hour_count, y in self._query('SELECT ts, count, "{0}" FROM hourly WHERE ts > ? AND ts < ? AND '
+                                                   '"{0}" IS NOT NULL'.format(rtype), (start - HOUR_MS, end)):
+                first = max(hour, start)
+                last = min(hour + HOUR_MS, end)
+                count = hour_count * (last - first) / HOUR_MS
+                x = ((first + last) / 2 - start) / 1000
+                result.merge(RangeSums(RegressionSums(count, count * x, count * y, count * x * y, count * x * x,
+                                                      count * y * y), y, y))
+        return results
+
+    def quantiles(self, rtype, start_time, end_time, qs=(0.5, 0.95, 0.99)):
+        """Like in Mongo: the hourly sketches merged for the whole hours they cover and the raw readings of the rest,
+           to within 1%. Readings summarised before the sketches existed are left out."""
+        sketch = QuantileSketch()
+        start = to_millis(start_time)
+        end = to_millis(end_time) + 1
+        raw = [(start, end)]
+        self._connection()
+        since = self._sketches_since()
+        if since is not None and since < end:
+            first = -(-max(start, since) // HOUR_MS) * HOUR_MS
+            last = end // HOUR_MS * HOUR_MS
+            if first < last:
+                sketch.merge(dict(self._query("SELECT bin, SUM(count) FROM sketches WHERE type = ? AND hour >= ? AND "
+                                              "hour < ? GROUP BY bin", (rtype, first, last)).fetchall()))
+                raw = [(start, first), (last, end)]
+        for lo, hi in raw:
+            if lo < hi:
+                for row in self._query('SELECT "{0}" FROM readings WHERE ts >= ? AND ts < ? AND "{0}" IS NOT NULL'
+                                       .format(rtype), (lo, hi)):
+                    sketch.add(row[0])
+        return {q: sketch.quantile(q) for q in qs}
+
+    def points(self, rtype, start_time, end_time):
+        start = to_millis(start_time)
+        end = to_millis(end_time)
+        times = []
+        values = []
+        for table, offset in (('hourly', HOUR_MS // 2), ('readings', 0)):
+            cursor = self._query('SELECT ts + ?, "{0}" FROM {1} WHERE ts >= ? AND ts <= ? AND "{0}" IS NOT NULL '
+                                 'ORDER BY ts'.format(rtype, table), (offset, start - offset, end - offset))
+            while True:
+                rows = cursor.fetchmany(5000)
+                if not rows:
+                    break
+                times.append(numpy.fromiter((t for t, _ in rows), dtype=numpy.int64, count=len(rows)))
+                values.append(numpy.fromiter((y for _, y in rows), dtype=numpy.float64, count=len(rows)))
+        if not times:
+            return numpy.empty(0, dtype=numpy.int64), numpy.empty(0)
+        return numpy.concatenate(times), numpy.concatenate(values)
+
+    def latest(self):
+        row = self._query("SELECT ts, {} FROM readings ORDER BY ts DESC LIMIT 1".format(self._columns())).fetchone()
+        return self._doc(row, self._types) if row is not None else None
+
+    def latest_rows(self, count):
+        rows = [self._doc(row, self._types) for row in self._query(
+            "SELECT ts, {} FROM readings ORDER BY ts DESC LIMIT ?".format(self._columns()), (count,))]
+        if len(rows) < count:
+            rows += [self._doc(row, self._types) for row in self._query(
+                "SELECT ts, {} FROM hourly ORDER BY ts DESC LIMIT ?".format(self._columns()), (count - len(rows),))]
+        rows.reverse()
+        return rows
+
+    def scan(self, fields, after=None, before=None, descending=False, limit=0):
+        conditions = []
+        params = []
+        if after is not None:
+            conditions.append("ts > ?")
+            params.append(to_millis(after))
+        if before is not None:
+            conditions.append("ts < ?")
+            params.append(to_millis(before))
+        sql = "SELECT ts, {} FROM readings{} ORDER BY ts {} LIMIT ?".format(
+            self._columns(fields), " WHERE " + " AND ".join(conditions) if conditions else "",
+            "DESC" if descending else "ASC")
+        cursor = self._query(sql, params + [limit if limit else -1])
+        return self._rows(cursor, fields)
+
+    def _rows(self, cursor, fields):
+        try:
+            while True:
+                rows = cursor.fetchmany(1000)
+                if not rows:
+                    return
+                for row in rows:
+                    yield self._doc(row, fields)
+        finally:
+            cursor.close()
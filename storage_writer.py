@@ -0,0 +1,195 @@
+import collections
+import logging
+import os
+import queue
+import threading
+import time
+
+from bson import ObjectId, json_util
+
+import metrics
+from storage import StorageError
+
+
+class StorageWriter:
+    """Writes readings to the storage (Mongo, or SQLite on a standalone unit) in batches from a background thread.
+       While the storage can't be reached the readings are appended to a spool file, which is replayed in bulk once
+       it is back. If the spool file can't be written either (a full or read-only disk) the readings are held in
+       memory, up to max_held of them, and written with the next batch that gets through."""
+
+    def __init__(self, storage, spool_file, max_queue=1000, batch_size=50, flush_interval=60, retry_interval=30,
+                 replay_batch_size=1000, max_held=100000):
+        self._storage = storage
+        self._spool_file = spool_file
+        self._replay_file = spool_file + '.replay'
+        self._queue = queue.Queue(max_queue)
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._retry_interval = retry_interval
+        self._replay_batch_size = replay_batch_size
+        self._spool_lock = threading.Lock()
+        # Readings that could neither be stored nor spooled
+        self._held = collections.deque(maxlen=max_held)
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="storage-writer", daemon=True)
+        self._next_attempt = 0
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stop the writer; whatever is still queued is written or spooled first"""
+        self._stop_event.set()
+        self._thread.join(timeout)
+
+    def put(self, reading):
+        """Queue a reading for writing. Never blocks on the storage."""
+        # A client side _id makes replays idempotent: a reading that already made it in is a duplicate key
+        reading.setdefault('_id', ObjectId())
+        try:
+            self._queue.put_nowait(reading)
+        except queue.Full:
+            logging.warning("Write queue full - spooling reading")
+            try:
+                self._spool([reading])
+            except Exception as e:
+                # Never let the writer's trouble reach the sampling thread
+                logging.error("Could not spool reading: {}".format(e))
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def _take_batch(self):
+        """Up to batch_size readings, waiting at most flush_interval after the first one for the rest"""
+        batch = []
+        while not batch and not self._stop_event.is_set():
+            try:
+                # Short waits, so stop() isn't held up
+                batch.append(self._queue.get(timeout=1))
+            except queue.Empty:
+                pass
+        deadline = time.monotonic() + self._flush_interval
+        while batch and len(batch) < self._batch_size and not self._stop_event.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=min(remaining, 1)))
+            except queue.Empty:
+                pass
+        return batch
+
+    def _drain(self):
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                return batch
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            batch = self._take_batch()
+            if batch:
+                self._safe_write(batch)
+        batch = self._drain()
+        if batch:
+            self._safe_write(batch)
+
+    def _safe_write(self, batch):
+        """Write a batch, and the readings held before; whatever goes wrong is logged and the batch spooled, so the
+           writer thread keeps running"""
+        batch = self._take_held() + batch
+        try:
+            self._write(batch)
+        except Exception:
+            logging.exception("Writing {} readings failed - spooling them".format(len(batch)))
+            self._spool(batch)
+
+    def _take_held(self):
+        with self._spool_lock:
+            held = list(self._held)
+            self._held.clear()
+        return held
+
+    def _write(self, batch):
+        if time.monotonic() < self._next_attempt:
+            # The storage was down a moment ago; don't wait for another timeout
+            self._spool(batch)
+            return
+        if not self._insert(batch):
+            self._spool(batch)
+        elif self._has_spool():
+            self._replay()
+
+    def _insert(self, docs):
+        """Insert the documents; returns False if they could not all be stored"""
+        start = time.monotonic()
+        try:
+            self._storage.insert(docs)
+            metrics.STORAGE_INSERT_SECONDS.observe(time.monotonic() - start)
+        except StorageError as e:
+            logging.error("Could not store the readings - spooling them: {}".format(e))
+            self._next_attempt = time.monotonic() + self._retry_interval
+            return False
+        return True
+
+    def _has_spool(self):
+        return os.path.exists(self._replay_file) or os.path.exists(self._spool_file)
+
+    def _spool(self, docs):
+        with self._spool_lock:
+            docs = list(self._held) + list(docs)
+            try:
+                with open(self._spool_file, 'a') as f:
+                    for doc in docs:
+                        f.write(json_util.dumps(doc, json_options=json_util.RELAXED_JSON_OPTIONS))
+                        f.write("\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+            except OSError as e:
+                self._held.clear()
+                self._held.extend(docs)
+                dropped = len(docs) - len(self._held)
+                logging.error("Could not spool readings - holding {} in memory{}: {}".format(
+                    len(self._held), ", dropped the {} oldest".format(dropped) if dropped else "", e))
+                return
+            self._held.clear()
+        metrics.STORAGE_SPOOLED_READINGS.inc(len(docs))
+
+    def _replay(self):
+        """Insert the spooled readings in bulk. A replay that fails halfway is restarted from the beginning of the
+           file later; readings that already made it in are skipped as duplicates."""
+        with self._spool_lock:
+            if not os.path.exists(self._replay_file):
+                if not os.path.exists(self._spool_file):
+                    return True
+                os.replace(self._spool_file, self._replay_file)
+        count = 0
+        batch = []
+        with open(self._replay_file) as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    batch.append(json_util.loads(line))
+                except ValueError:
+                    # Partial line left by a crash while spooling
+                    logging.warning("Skipping corrupt spooled reading: {}".format(line))
+                    continue
+                if len(batch) >= self._replay_batch_size:
+                    if not self._insert(batch):
+                        return False
+                    count += len(batch)
+                    batch = []
+        if batch:
+            if not self._insert(batch):
+                return False
+            count += len(batch)
+        os.remove(self._replay_file)
+        logging.info("Replayed {} spooled readings".format(count))
+        if count:
+            # The replayed readings went into buckets that may have been cached as closed already
+            self._storage.invalidate()
+        return True
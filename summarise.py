@@ -1,55 +1,201 @@
 import datetime
-import os
-import sys
-import tzlocal
+import logging
 
-sys.path.insert(0, os.path.join(os.path.dirname(__file__), "html"))
+import pymongo.errors
+import pytz
+import tzlocal
+from bson import ObjectId
+from pymongo import ReplaceOne
 
 from mongo_connector import MongoConnector
 from config import config
-from enviro import types
+from rollup import HOUR_MS, to_millis, from_millis
+from sensor_types import types
 from dateutil.relativedelta import relativedelta
 
 
-def summarise_data(months_retained=2):
-    local_tz = str(tzlocal.get_localzone())
-    mc = MongoConnector(config)
-    col = mc.get_collection()
-    hc = mc.get_aggregate_collection()
+# The readings an hourly row stored before the rows had a count stands for: an hour of readings 5 seconds apart
+DEFAULT_COUNT = 720
+
 
-    start_time = datetime.datetime.now() - relativedelta(months=months_retained)
-    start_time = datetime.datetime(start_time.year, start_time.month, start_time.day, 0, 0, 0, 0)
-    mask = {"timestamp": {"$lte": start_time}}
+def summarise_pipeline(start_time, end_time):
+    """Averages per hour of the readings from start_time up to end_time"""
+    mask = {"timestamp": {"$gte": start_time, "$lt": end_time}}
 
     match = {"$match": {'$and': [mask]}}
+    # Hours in UTC; the hour's start is stored as a proper UTC timestamp together with the number of readings
     group = {
         "$group": {
             "_id": {
-                "hour": {"$hour": {"date": "$timestamp", "timezone": local_tz}},
-                "day": {"$dayOfMonth": {"date": "$timestamp", "timezone": local_tz}},
-                "month": {"$month": {"date": "$timestamp", "timezone": local_tz}},
-                "year": {"$year": {"date": "$timestamp", "timezone": local_tz}}
+                "hour": {"$hour": "$timestamp"},
+                "day": {"$dayOfMonth": "$timestamp"},
+                "month": {"$month": "$timestamp"},
+                "year": {"$year": "$timestamp"}
             },
-            "ids": {"$addToSet": "$_id"}
+            "count": {"$sum": 1}
         }
     }
 
     for tp in types:
         group["$group"][tp] = {"$avg": "${}".format(tp)}
 
-    query = [
+    return [
         match,
         group
     ]
 
-    res = col.aggregate(query)
-    for i in res:
-        ids = i['ids']
-        ts = datetime.datetime(hour=i["_id"]['hour'], day=i["_id"]['day'], month=i["_id"]['month'],
-                               year=i["_id"]['year'])
-        y = dict(i)
-        y['timestamp'] = ts
-        del y['ids'], y['_id']
-        hc.insert_one(y)
-        col.delete_many({"_id": {"$in": ids}})
 
+def cutoff_time(months_retained):
+    """Local midnight months_retained months ago, in UTC"""
+    local_tz = tzlocal.get_localzone()
+    start_time = datetime.datetime.now(local_tz) - relativedelta(months=months_retained)
+    midnight = datetime.datetime(start_time.year, start_time.month, start_time.day, 0, 0, 0, 0)
+    if hasattr(local_tz, 'localize'):
+        midnight = local_tz.localize(midnight)
+    else:
+        midnight = midnight.replace(tzinfo=local_tz)
+    return midnight.astimezone(pytz.UTC)
+
+
+class Compactor:
+    """Replaces the readings from before the retention period by hourly averages, chunk_hours hours at a time. The
+       hours of a chunk are upserted into the hourly collection in bulk, keyed on the start of the hour so doing it
+       again is harmless, and then its readings are removed with one range delete. Both steps move a high-water mark
+       in the state collection, so an interrupted run carries on where it stopped: hours that were upserted but whose
+       readings may be partly deleted are only deleted, never averaged again. Readings that come in below the mark
+       later (from the spool, say) are averaged into their hours first."""
+    STATE_ID = 'summarise'
+
+    def __init__(self, mc, state_collection='compaction', chunk_hours=6, default_count=DEFAULT_COUNT):
+        self._collection = mc.get_collection()
+        self._hourly = mc.get_aggregate_collection()
+        self._state = mc.get_db()[state_collection]
+        self._chunk = chunk_hours * HOUR_MS
+        self._default_count = default_count
+
+    def _marks(self):
+        """The (upserted, deleted) high-water marks in ms; None where nothing was done yet"""
+        state = self._state.find_one({'_id': self.STATE_ID}) or {}
+        return tuple(to_millis(state[key]) if state.get(key) is not None else None for key in ('upserted', 'deleted'))
+
+    def _set_mark(self, name, ms):
+        self._state.update_one({'_id': self.STATE_ID}, {'$set': {name: from_millis(ms)}}, upsert=True)
+
+    def _delete(self, start, end):
+        query = {"timestamp": {"$lt": from_millis(end)}}
+        if start is not None:
+            query["timestamp"]["$gte"] = from_millis(start)
+        count = self._collection.delete_many(query).deleted_count
+        self._set_mark('deleted', end)
+        return count
+
+    def _merge_late(self, below, limit=10000):
+        """Average the readings from before below (ms), whose hours were summarised already, into those hours and
+           remove them. The readings are listed in the state document and every hour is marked with a token when it
+           is updated, so an interrupted merge is finished later without counting a reading twice."""
+        state = self._state.find_one({'_id': self.STATE_ID}) or {}
+        late = state.get('late')
+        if late is None:
+            ids = [doc['_id'] for doc in self._collection.find({"timestamp": {"$lt": from_millis(below)}}, {"_id": 1})
+                   .limit(limit)]
+            if not ids:
+                return 0
+            late = {'token': ObjectId(), 'ids': ids}
+            self._state.update_one({'_id': self.STATE_ID}, {'$set': {'late': late}}, upsert=True)
+        pipeline = summarise_pipeline(from_millis(0), from_millis(below))
+        pipeline[0] = {"$match": {"_id": {"$in": late['ids']}}}
+        for row in self._collection.aggregate(pipeline):
+            ts = datetime.datetime(hour=row["_id"]['hour'], day=row["_id"]['day'], month=row["_id"]['month'],
+                                   year=row["_id"]['year'], tzinfo=pytz.UTC)
+            hour = self._hourly.find_one({"timestamp": ts})
+            if hour is not None and hour.get('merge') == late['token']:
+                continue
+            merged = {'timestamp': ts, 'count': row['count'], 'merge': late['token']}
+            count = hour.get('count', self._default_count) if hour is not None else 0
+            for tp in types:
+                old, new = hour.get(tp) if hour is not None else None, row.get(tp)
+                if old is None or new is None:
+                    merged[tp] = new if old is None else old
+                else:
+                    merged[tp] = (old * count + new * row['count']) / (count + row['count'])
+            merged['count'] += count
+            self._hourly.replace_one({"timestamp": ts}, merged, upsert=True)
+        count = self._collection.delete_many({"_id": {"$in": late['ids']}}).deleted_count
+        self._state.update_one({'_id': self.STATE_ID}, {'$unset': {'late': 1}})
+        return count
+
+    def _upsert(self, start, end):
+        updates = []
+        for row in self._collection.aggregate(summarise_pipeline(from_millis(start), from_millis(end))):
+            ts = datetime.datetime(hour=row["_id"]['hour'], day=row["_id"]['day'], month=row["_id"]['month'],
+                                   year=row["_id"]['year'], tzinfo=pytz.UTC)
+            del row['_id']
+            row['timestamp'] = ts
+            updates.append(ReplaceOne({"timestamp": ts}, row, upsert=True))
+        if updates:
+            self._hourly.bulk_write(updates, ordered=False)
+        self._set_mark('upserted', end)
+        return len(updates)
+
+    def run(self, months_retained=2, max_chunks=4):
+        """Compact at most max_chunks chunks (all of them if None) of the hours before the cutoff. Returns the number
+           of hours summarised."""
+        hours = 0
+        try:
+            cutoff = to_millis(cutoff_time(months_retained)) // HOUR_MS * HOUR_MS
+            upserted, deleted = self._marks()
+            if upserted is not None and (deleted is None or upserted > deleted):
+                # Interrupted between the two steps
+                count = self._delete(deleted, upserted)
+                logging.info("Removed {} summarised readings before {}".format(count, from_millis(upserted)))
+            if upserted is not None:
+                count = self._merge_late(upserted)
+                if count:
+                    logging.info("Averaged {} late readings into the hours before {}".format(count,
+                                                                                          from_millis(upserted)))
+            first = self._collection.find_one({}, {"timestamp": 1}, sort=[("timestamp", 1)])
+            if first is None:
+                return 0
+            start = to_millis(first['timestamp']) // HOUR_MS * HOUR_MS
+            if upserted is not None:
+                start = max(start, upserted)
+            chunks = 0
+            while max_chunks is None or chunks < max_chunks:
+                end = min(start + self._chunk, cutoff)
+                if end <= start:
+                    break
+                count = self._upsert(start, end)
+                removed = self._delete(start, end)
+                logging.info("Summarised {} readings from {} into {} hours".format(removed, from_millis(start), count))
+                hours += count
+                chunks += 1
+                start = end
+        except pymongo.errors.PyMongoError as e:
+            logging.error("Summarising failed: {}".format(e))
+        return hours
+
+
+def summarise_data(months_retained=2):
+    """Summarise everything from before the retention period in one go"""
+    mc = MongoConnector(config)
+    return Compactor(mc, config.get('compaction_collection', 'compaction')).run(months_retained, None)
+
+
+def query_shapes(mc, months_retained=2):
+    """An example of every query shape the summariser issues, as (name, collection, kind, spec) for
+       MongoConnector.audit()"""
+    end_time = cutoff_time(months_retained)
+    start_time = end_time - datetime.timedelta(hours=6)
+    return [
+        ('summarise', mc.get_collection(), 'aggregate', summarise_pipeline(start_time, end_time)),
+        ('store hour', mc.get_aggregate_collection(), 'update',
+         {'filter': {"timestamp": start_time}, 'update': {"count": 0}, 'upsert': True}),
+        ('delete summarised', mc.get_collection(), 'delete',
+         {'filter': {"timestamp": {"$gte": start_time, "$lt": end_time}}}),
+    ]
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s.%(msecs)03d %(levelname)-8s %(message)s', level=logging.INFO,
+                        datefmt='%Y-%m-%d %H:%M:%S')
+    logging.info("Summarised {} hours".format(summarise_data()))
@@ -0,0 +1,182 @@
+import collections
+import math
+
+
+class RegressionSums:
+    """The sums a least squares line fit needs (n, Σx, Σy, Σxy, Σx², Σy²). Samples can be added and removed, and
+       sums of disjoint sets of samples merged, so fitting never has to go back to the samples themselves."""
+
+    def __init__(self, n=0, sx=0.0, sy=0.0, sxy=0.0, sxx=0.0, syy=0.0):
+        self.n = n
+        self.sx = sx
+        self.sy = sy
+        self.sxy = sxy
+        self.sxx = sxx
+        self.syy = syy
+
+    def add(self, x, y):
+        self.n += 1
+        self.sx += x
+        self.sy += y
+        self.sxy += x * y
+        self.sxx += x * x
+        self.syy += y * y
+
+    def remove(self, x, y):
+        self.n -= 1
+        self.sx -= x
+        self.sy -= y
+        self.sxy -= x * y
+        self.sxx -= x * x
+        self.syy -= y * y
+
+    def merge(self, other):
+        """Add the sums of another, disjoint, set of samples"""
+        self.n += other.n
+        self.sx += other.sx
+        self.sy += other.sy
+        self.sxy += other.sxy
+        self.sxx += other.sxx
+        self.syy += other.syy
+        return self
+
+    def shifted(self, offset):
+        """The sums of the same samples with offset added to every x"""
+        return RegressionSums(self.n, self.sx + self.n * offset, self.sy, self.sxy + offset * self.sy,
+                              self.sxx + 2 * offset * self.sx + self.n * offset * offset, self.syy)
+
+    def mean(self):
+        return self.sy / self.n if self.n > 0 else None
+
+    def variance(self):
+        """Population variance of y"""
+        if self.n == 0:
+            return None
+        return max(self.syy / self.n - (self.sy / self.n) ** 2, 0.0)
+
+    def fit(self):
+        """Slope, intercept and r² of the least squares line; None if there are too few distinct x values"""
+        if self.n < 2:
+            return None
+        sxx = self.sxx - self.sx * self.sx / self.n
+        sxy = self.sxy - self.sx * self.sy / self.n
+        syy = self.syy - self.sy * self.sy / self.n
+        if sxx <= 0:
+            return None
+        slope = sxy / sxx
+        intercept = (self.sy - slope * self.sx) / self.n
+        # r² = 1 - var(residuals) / var(y), which for a least squares fit reduces to this
+        r_squared = sxy * sxy / (sxx * syy) if syy > 0 else 0.0
+        return slope, intercept, r_squared
+
+
+class RangeSums:
+    """Regression sums (x in seconds since the start of the range) plus the minimum and maximum of y"""
+
+    def __init__(self, sums=None, minimum=None, maximum=None):
+        self.sums = sums if sums is not None else RegressionSums()
+        self.min = minimum
+        self.max = maximum
+
+    def merge(self, other, offset=0.0):
+        """Add the readings of another range, whose x is measured from offset seconds after the start of this one"""
+        self.sums.merge(other.sums.shifted(offset))
+        if other.min is not None:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+        if other.max is not None:
+            self.max = other.max if self.max is None else max(self.max, other.max)
+        return self
+
+
+class TrendEstimator:
+    """Least squares trend over a sliding window of (time, value) samples. The window is limited by time span, by
+       number of samples, or both. Adding a sample and fitting are O(1)."""
+
+    def __init__(self, window=None, max_samples=None, rebase_every=10000):
+        self._window = window
+        self._max_samples = max_samples
+        self._rebase_every = rebase_every
+        self._samples = collections.deque()
+        self._sums = RegressionSums()
+        # x is kept relative to the oldest sample, otherwise the squares of epoch seconds eat up the precision
+        self._origin = None
+        self._updates = 0
+
+    def add(self, t, y):
+        if self._origin is None:
+            self._origin = t
+        self._samples.append((t, y))
+        self._sums.add(t - self._origin, y)
+        while (self._window is not None and t - self._samples[0][0] > self._window) or \
+                (self._max_samples is not None and len(self._samples) > self._max_samples):
+            old_t, old_y = self._samples.popleft()
+            self._sums.remove(old_t - self._origin, old_y)
+        self._updates += 1
+        if self._updates >= self._rebase_every:
+            self._rebase()
+
+    def _rebase(self):
+        """Recompute the sums from the window now and then, so rounding errors of the removals can't build up"""
+        self._updates = 0
+        self._origin = self._samples[0][0]
+        self._sums = RegressionSums()
+        for t, y in self._samples:
+            self._sums.add(t - self._origin, y)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def span(self):
+        """Time between the oldest and the newest sample in the window"""
+        if not self._samples:
+            return 0
+        return self._samples[-1][0] - self._samples[0][0]
+
+    def mean(self):
+        return self._sums.mean()
+
+    def fit(self):
+        """Slope (per time unit), intercept and r² of the trend line; None if there is not enough data"""
+        line = self._sums.fit()
+        if line is None:
+            return None
+        slope, intercept, r_squared = line
+        return slope, intercept - slope * self._origin, r_squared
+
+    def change_per_hour(self):
+        """Slope of the trend line per hour, for samples timed in seconds"""
+        line = self.fit()
+        return line[0] * 60 * 60 if line is not None else 0
+
+
+if __name__ == '__main__':
+    # Compare against the numpy.polyfit calculation this replaces
+    import numpy
+
+    rng = numpy.random.default_rng(1)
+    estimator = TrendEstimator(max_samples=1000, rebase_every=1500)
+    ts = []
+    ys = []
+    t = 1.6e9
+    for i in range(5000):
+        t += rng.uniform(1, 10)
+        y = 1013 + 0.001 * (t - 1.6e9) / 60 + rng.normal(0, 0.5)
+        estimator.add(t, y)
+        ts = (ts + [t])[-1000:]
+        ys = (ys + [y])[-1000:]
+        if i % 500 == 499:
+            line = numpy.polyfit(ts, ys, 1, full=True)
+            slope, intercept = line[0]
+            residuals = numpy.var([(slope * x + intercept - y) for x, y in zip(ts, ys)])
+            r_squared = 1 - residuals / numpy.var(ys)
+            fit = estimator.fit()
+            assert math.isclose(fit[0], slope, rel_tol=1e-7), (fit[0], slope)
+            assert math.isclose(fit[1], intercept, rel_tol=1e-7), (fit[1], intercept)
+            assert math.isclose(fit[2], r_squared, rel_tol=1e-7), (fit[2], r_squared)
+            assert math.isclose(estimator.mean(), numpy.mean(ys), rel_tol=1e-12)
+    windowed = TrendEstimator(window=3 * 60 * 60)
+    for i in range(10000):
+        windowed.add(i * 5.0, i)
+    assert len(windowed) == 3 * 60 * 60 // 5 + 1 and windowed.span() == 3 * 60 * 60
+    assert math.isclose(windowed.change_per_hour(), 60 * 60 / 5)
+    print("ok")